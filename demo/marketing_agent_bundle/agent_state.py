@@ -1,4 +1,30 @@
-from typing import Dict, List, Any, TypedDict, Literal
+from typing import Dict, List, Any, TypedDict, Literal, NotRequired, Optional
+import os
+import re
+import threading
+import uuid
+from pydantic import BaseModel, Field
+
+# Question categories tracked by the message index, matched in a single pass over the content.
+# Only the budget check ignores case; the other two phrases must match exactly
+_QUESTION_CATEGORY_RE = re.compile(
+  r"(focus more on social media or search ads)|(start the marketing campaign)|((?i:budget))"
+)
+_FOCUS_QUESTION, _CAMPAIGN_QUESTION, _BUDGET_QUESTION = 1, 2, 3
+
+# Running summary of state["messages"], updated incrementally as messages are appended
+class MessageIndex(TypedDict):
+  list_id: int # id() of the messages list the index was built from
+  synced_len: int # number of messages already folded into the index
+  focus_q_count: int
+  budget_q_count: int
+  campaign_q_count: int
+  last_human_idx: Optional[int] # position of the latest human message, if any
+  last_ai_idx: Optional[int] # position of the latest AI message, if any
+  instagram_asked: bool # whether any AI message has mentioned Instagram
+  start_date_asked: bool # whether any AI message has asked about the campaign start
+  final_confirm_asked: bool # whether any AI message has offered to generate the final plan
+  message_ids: Dict[str, bool] # IDs of the indexed messages; a dict rather than a set so the state stays JSON-serializable
 
 # Define types
 class MarketingPlanState(TypedDict):
@@ -9,4 +35,142 @@ class MarketingPlanState(TypedDict):
   budget_allocation: Dict[str, int]
   ad_creatives: List[Dict[str, Any]]
   user_input: Dict[str, Any]
-  current_stage: Literal["initial", "data_gathering", "analysis", "refinement", "final"] 
\ No newline at end of file
+  current_stage: Literal["initial", "data_gathering", "analysis", "refinement", "final"]
+  message_index: NotRequired[MessageIndex]
+
+# Random bytes for message IDs, drawn from os.urandom in blocks instead of once per ID
+_ID_POOL_SIZE = 64
+_id_pool = b""
+_id_pool_offset = 0
+_id_pool_lock = threading.Lock()
+
+def _reset_id_pool() -> None:
+  global _id_pool, _id_pool_offset
+  _id_pool, _id_pool_offset = b"", 0
+
+# A forked child must not hand out the same IDs as its parent
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_reset_id_pool)
+
+def new_message_id() -> str:
+  """Return a random UUID4 string for a new message.
+
+  Same format as str(uuid.uuid4()), which agent-chat-ui expects, but one
+  urandom read serves _ID_POOL_SIZE IDs.
+  """
+  global _id_pool, _id_pool_offset
+  with _id_pool_lock:
+    if _id_pool_offset >= len(_id_pool):
+      _id_pool, _id_pool_offset = os.urandom(16 * _ID_POOL_SIZE), 0
+    raw = _id_pool[_id_pool_offset:_id_pool_offset + 16]
+    _id_pool_offset += 16
+  return str(uuid.UUID(bytes=raw, version=4))
+
+def _new_message_index(messages: List[Dict[str, Any]]) -> MessageIndex:
+  return {
+    "list_id": id(messages),
+    "synced_len": 0,
+    "focus_q_count": 0,
+    "budget_q_count": 0,
+    "campaign_q_count": 0,
+    "last_human_idx": None,
+    "last_ai_idx": None,
+    "instagram_asked": False,
+    "start_date_asked": False,
+    "final_confirm_asked": False,
+    "message_ids": {}
+  }
+
+def _index_message(index: MessageIndex, position: int, msg: Dict[str, Any]) -> None:
+  """Fold a single appended message into the index."""
+  msg_id = msg.get("id")
+  if msg_id is not None:
+    index["message_ids"][str(msg_id)] = True
+
+  msg_type = msg.get("type")
+  if msg_type == "human":
+    index["last_human_idx"] = position
+  elif msg_type == "ai":
+    index["last_ai_idx"] = position
+    content_lower = (msg.get("content") or "").lower()
+    if not index["instagram_asked"] and "instagram" in content_lower:
+      index["instagram_asked"] = True
+    if not index["start_date_asked"] and "start" in content_lower and "campaign" in content_lower:
+      index["start_date_asked"] = True
+    if not index["final_confirm_asked"] and "generate" in content_lower and "final" in content_lower:
+      index["final_confirm_asked"] = True
+
+  categories = {match.lastindex for match in _QUESTION_CATEGORY_RE.finditer(msg.get("content") or "")}
+  if not categories:
+    return
+
+  # Repeated system-4 focus questions
+  if _FOCUS_QUESTION in categories and msg.get("id") == "system-4":
+    index["focus_q_count"] += 1
+
+  if msg_type == "ai":
+    if _BUDGET_QUESTION in categories:
+      index["budget_q_count"] += 1
+    if _CAMPAIGN_QUESTION in categories:
+      index["campaign_q_count"] += 1
+
+def sync_message_index(state: MarketingPlanState) -> MessageIndex:
+  """Bring state["message_index"] up to date with state["messages"] and return it.
+
+  Messages are only ever appended, so only the ones added since the last sync
+  are inspected. The index is rebuilt if the messages list was replaced or shrank.
+  """
+  messages = state.get("messages") or []
+  index = state.get("message_index")
+  if index is None or index["list_id"] != id(messages) or index["synced_len"] > len(messages):
+    index = _new_message_index(messages)
+    state["message_index"] = index
+
+  for position in range(index["synced_len"], len(messages)):
+    _index_message(index, position, messages[position])
+  index["synced_len"] = len(messages)
+  return index
+
+def has_message_id(state: MarketingPlanState, message_id: Any) -> bool:
+  """Return whether state["messages"] already contains a message with this ID.
+
+  The IDs are kept in the message index, so only messages appended since the
+  last sync are inspected.
+  """
+  return message_id is not None and str(message_id) in sync_message_index(state)["message_ids"]
+
+# Structured LLM outputs parsed by the graph nodes
+class BusinessInfo(BaseModel):
+  industry: str = Field(description="The industry name")
+  products: List[str] = Field(default_factory=list, description="The business's products or services")
+  target_audience: str = Field(default="", description="Detailed description of target audience")
+  existing_marketing: str = Field(default="", description="Description of marketing strategies")
+
+class Competitor(BaseModel):
+  competitor_name: str = Field(description="Competitor Name")
+  ad_platforms: List[str] = Field(default_factory=list, description="Platforms the competitor advertises on")
+  audience: str = Field(default="", description="Detailed description of their target audience")
+  budget_estimate: str = Field(default="", description="Estimated marketing budget if available")
+
+class Competitors(BaseModel):
+  competitors: List[Competitor] = Field(description="The top competitors in the industry")
+
+class AdCreative(BaseModel):
+  platform: str = Field(description="The channel the ad runs on")
+  ad_type: str = Field(description="Type of ad")
+  creative: str = Field(description="Detailed and specific creative suggestion tailored to this business")
+
+class MarketingPlan(BaseModel):
+  recommended_channels: List[str] = Field(description="Specific platform names, e.g. LinkedIn Ads rather than just Social Media")
+  industry_specific_strategy: str = Field(default="", description="Why these channels are particularly effective for this business type and industry")
+  budget_allocation: Dict[str, int] = Field(description="Percentage of the budget per channel, adding up to 100")
+  ad_creatives: List[AdCreative] = Field(default_factory=list)
+
+class TurnAnalysis(BaseModel):
+  focus: Optional[Literal["social media", "search ads", "balanced", "unclear"]] = Field(default=None, description="The user's marketing focus preference, when asked to determine it")
+  instagram_pct: Optional[int] = Field(default=None, description="Percentage of the budget the user wants for Instagram ads, when asked to determine it")
+  has_start_date: bool = Field(default=False, description="Whether the user's message contains a campaign start date or timeframe")
+  next_question: str = Field(description="The next message to send to the user")
+
+class GreetingVerdict(BaseModel):
+  is_greeting: bool = Field(description="Whether the message is only a greeting or introduction without a business URL or other substantive information")
@@ -1,6 +1,128 @@
 from langchain.tools import BaseTool
 from langchain_community.tools.tavily_search import TavilySearchResults
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import functools
 import json
+import time
+
+# Cached entries are (stored_at, value); both caches share the same TTL
+_CACHE_TTL_SECONDS = 3600
+
+# Website analysis results keyed by URL
+_ANALYSIS_CACHE_MAX_ENTRIES = 128
+_analysis_cache: Dict[str, Tuple[float, str]] = {}
+
+# Tavily search results keyed by (query, k)
+_SEARCH_CACHE_MAX_ENTRIES = 512
+_search_cache: Dict[Tuple[str, int], Tuple[float, Any]] = {}
+
+def _cache_get(cache: Dict[Any, Tuple[float, Any]], key: Any) -> Optional[Any]:
+  """Return the cached value for a key if it has not expired."""
+  entry = cache.get(key)
+  if entry is None:
+    return None
+  stored_at, value = entry
+  if time.monotonic() - stored_at >= _CACHE_TTL_SECONDS:
+    cache.pop(key, None)
+    return None
+  return value
+
+def _cache_store(cache: Dict[Any, Tuple[float, Any]], key: Any, value: Any, max_entries: int) -> None:
+  """Cache a value, evicting the oldest entry when the cache is full."""
+  if key not in cache and len(cache) >= max_entries:
+    cache.pop(next(iter(cache)), None)
+  cache[key] = (time.monotonic(), value)
+
+def _website_queries(url: str):
+  """Return the (business, competitor) search queries for a website."""
+  return (
+    f"information about business at {url} including industry, products, services and target audience",
+    f"major competitors of business at {url} and their marketing strategies"
+  )
+
+@functools.lru_cache(maxsize=None)
+def _search_tool(k: int = 5) -> TavilySearchResults:
+  """Return the shared Tavily search tool for a result count, created on first use."""
+  return TavilySearchResults(k=k)
+
+# Only these fields of each Tavily hit are used in prompts; long page content is truncated
+_RESULT_FIELDS = ("title", "url", "content")
+_RESULT_CONTENT_MAX_CHARS = 500
+
+def _trim_results(results: Any) -> Any:
+  """Keep only the fields the prompts need from a Tavily result list."""
+  if not isinstance(results, list):
+    return results
+  trimmed = []
+  for hit in results:
+    if not isinstance(hit, dict):
+      trimmed.append(hit)
+      continue
+    entry = {field: hit[field] for field in _RESULT_FIELDS if field in hit}
+    if isinstance(entry.get("content"), str):
+      entry["content"] = entry["content"][:_RESULT_CONTENT_MAX_CHARS]
+    trimmed.append(entry)
+  return trimmed
+
+def _cached_searches(queries: Sequence[str], k: int) -> Tuple[List[Any], List[int]]:
+  """Return the cached results for queries (None where missing) and the positions still to search."""
+  results = [_cache_get(_search_cache, (query, k)) for query in queries]
+  missing = [position for position, result in enumerate(results) if result is None]
+  return results, missing
+
+def _store_searches(queries: Sequence[str], k: int, results: List[Any], missing: List[int], fetched: List[Any]) -> List[Any]:
+  """Trim freshly fetched results into their positions and cache the successful ones."""
+  for position, result in zip(missing, fetched):
+    result = _trim_results(result)
+    results[position] = result
+    # Tavily reports failures as an error string; only cache real result lists
+    if isinstance(result, list):
+      _cache_store(_search_cache, (queries[position], k), result, _SEARCH_CACHE_MAX_ENTRIES)
+  return results
+
+def search_many(queries: Sequence[str], k: int = 5) -> List[Any]:
+  """Run independent Tavily searches concurrently and return the results in query order.
+
+  Results are cached per query, so repeated searches (retries, or several
+  users in the same industry) skip the network round-trip.
+  """
+  results, missing = _cached_searches(queries, k)
+  if not missing:
+    return results
+
+  search_tool = _search_tool(k)
+  def search(position: int) -> Any:
+    return search_tool.invoke({"query": queries[position]})
+
+  if len(missing) == 1:
+    fetched = [search(missing[0])]
+  else:
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+      fetched = list(executor.map(search, missing))
+  return _store_searches(queries, k, results, missing, fetched)
+
+async def asearch_many(queries: Sequence[str], k: int = 5) -> List[Any]:
+  """Async counterpart of search_many, sharing its per-query cache and trimming."""
+  results, missing = _cached_searches(queries, k)
+  if not missing:
+    return results
+
+  search_tool = _search_tool(k)
+  fetched = await asyncio.gather(*(search_tool.ainvoke({"query": queries[position]}) for position in missing))
+  return _store_searches(queries, k, results, missing, list(fetched))
+
+def _website_analysis_result(url: str, business_search: Any, competitor_search: Any) -> str:
+  """Combine the two searches for a website and cache the result if both succeeded."""
+  result_json = json.dumps({
+    "business_info": business_search,
+    "competitor_info": competitor_search
+  })
+  # A failed search comes back as an error string; don't serve it from the cache for the whole TTL
+  if isinstance(business_search, list) and isinstance(competitor_search, list):
+    _cache_store(_analysis_cache, url, result_json, _ANALYSIS_CACHE_MAX_ENTRIES)
+  return result_json
 
 # Custom tool for gathering website data using Tavily
 class WebsiteAnalysisTool(BaseTool):
@@ -8,23 +130,20 @@ class WebsiteAnalysisTool(BaseTool):
   description: str = "Analyzes a business website to extract key information about the business."
 
   def _run(self, url: str) -> str:
-    # Use Tavily to search for information about the business website
-    search_tool = TavilySearchResults(k=5)
-
-    # First, search for basic business info
-    business_search = search_tool.invoke({
-      "query": f"information about business at {url} including industry, products, services and target audience"
-    })
-
-    # Then search for competitor information
-    competitor_search = search_tool.invoke({
-      "query": f"major competitors of business at {url} and their marketing strategies"
-    })
-
-    # Combine the results
-    result = {
-      "business_info": business_search,
-      "competitor_info": competitor_search
-    }
-
-    return json.dumps(result) 
\ No newline at end of file
+    # Repeated analyses of the same URL (e.g. when the graph loops) are served from the cache
+    cached = _cache_get(_analysis_cache, url)
+    if cached is not None:
+      return cached
+
+    # Use Tavily to search for information about the business website;
+    # the business and competitor searches are independent, so they run concurrently
+    business_search, competitor_search = search_many(_website_queries(url))
+    return _website_analysis_result(url, business_search, competitor_search)
+
+  async def _arun(self, url: str) -> str:
+    cached = _cache_get(_analysis_cache, url)
+    if cached is not None:
+      return cached
+
+    business_search, competitor_search = await asearch_many(_website_queries(url))
+    return _website_analysis_result(url, business_search, competitor_search)
@@ -1,8 +1,11 @@
-from typing import Literal
+from typing import Any, Dict, Literal, NamedTuple, Optional, Sequence, Tuple
+import functools
 import logging
+import os
+import re
 from langgraph.graph import StateGraph, END
 
-from .agent_state import MarketingPlanState # Assuming agent_state.py is in the same directory
+from .agent_state import MarketingPlanState, sync_message_index # Assuming agent_state.py is in the same directory
 # Import node functions from graph_nodes.py
 from .graph_nodes import (
     initialize_state,
@@ -16,82 +19,152 @@ from .graph_nodes import (
 
 logger = logging.getLogger(__name__)
 
+# Keyword sets used by the loop-detection checks
+_FINAL_PLAN_KEYWORDS = ("final plan", "generate plan", "create plan", "looks good", "satisfied")
+_CONFIRM_WORDS = ("yes", "yeah", "sure", "ok", "okay", "great")
+# Each keyword set as one alternation, so a message is searched once per set
+_FINAL_PLAN_RE = re.compile("|".join(map(re.escape, _FINAL_PLAN_KEYWORDS)))
+_CONFIRM_RE = re.compile("|".join(map(re.escape, _CONFIRM_WORDS)))
+
+_FINAL_PLAN_HUMAN_WINDOW = 10
+
+class _MessageScan(NamedTuple):
+  focus_count: int
+  budget_count: int
+  campaign_count: int
+  final_plan_found: bool
+  last5_confirm: bool
+
+# Recent-message flags keyed by (id(messages), len(messages)); the last message is kept to detect id reuse
+_recent_flags_cache: Dict[Tuple[int, int], Tuple[Any, Tuple[bool, bool]]] = {}
+_RECENT_FLAGS_CACHE_MAX_ENTRIES = 256
+
+def _scan_recent_human_messages(messages: Sequence[Dict[str, Any]]) -> Tuple[bool, bool]:
+  """Return (final_plan_found, last5_confirm) from the most recent human messages.
+
+  Older human messages cannot newly request the final plan (they would have
+  ended the workflow on an earlier call), so only the last
+  _FINAL_PLAN_HUMAN_WINDOW of them are checked.
+  """
+  final_plan_found = False
+  last5_confirm = False
+  humans_seen = 0
+
+  for distance, msg in enumerate(reversed(messages)):
+    if humans_seen >= _FINAL_PLAN_HUMAN_WINDOW and distance >= 5:
+      break
+    if msg.get("type") != "human":
+      continue
+
+    humans_seen += 1
+    content_lower = (msg.get("content") or "").lower()
+    if not final_plan_found and _FINAL_PLAN_RE.search(content_lower):
+      final_plan_found = True
+    # Look for confirmation words in the last 5 messages
+    if distance < 5 and _CONFIRM_RE.search(content_lower):
+      last5_confirm = True
+
+  return final_plan_found, last5_confirm
+
+def _cached_recent_flags(messages: Sequence[Dict[str, Any]]) -> Tuple[bool, bool]:
+  """Return the recent-message flags, reusing them while the list is unchanged.
+
+  should_end runs on every conditional edge, and the history usually has not
+  grown between two edges of the same turn.
+  """
+  if not messages:
+    return _scan_recent_human_messages(messages)
+
+  key = (id(messages), len(messages))
+  cached = _recent_flags_cache.get(key)
+  if cached is not None and cached[0] is messages[-1]:
+    return cached[1]
+
+  flags = _scan_recent_human_messages(messages)
+  if len(_recent_flags_cache) >= _RECENT_FLAGS_CACHE_MAX_ENTRIES:
+    _recent_flags_cache.clear()
+  _recent_flags_cache[key] = (messages[-1], flags)
+  return flags
+
+def _scan_messages(state: MarketingPlanState, messages: Sequence[Dict[str, Any]]) -> _MessageScan:
+  """Collect what the loop-detection checks need to know about the conversation.
+
+  Question counts come from the incrementally maintained message index, so
+  only the recent human messages are ever re-read.
+  """
+  index = sync_message_index(state)
+  final_plan_found, last5_confirm = _cached_recent_flags(messages)
+  return _MessageScan(
+    index["focus_q_count"],
+    index["budget_q_count"],
+    index["campaign_q_count"],
+    final_plan_found,
+    last5_confirm
+  )
+
 def should_end(state: MarketingPlanState) -> Literal["continue", END]:
   """Determine if the workflow should end."""
-  logger.info(f"🔄 LangGraph Flow Control: should_end - Current stage: {state.get('current_stage', 'unknown')}")
+  messages = state.get("messages") or ()
+  logger.info("🔄 LangGraph Flow Control: should_end - Current stage: %s", state.get("current_stage", "unknown"))
 
   # Explicit check for final stage
   if state.get("current_stage") == "final":
     logger.info("🔄 LangGraph Flow Control: should_end - Final stage detected, ending workflow")
+    # The conversation is finished; drop any flags cached for it
+    _recent_flags_cache.pop((id(messages), len(messages)), None)
     return END
 
   # Detect loops - check for repeated messages of the same content
-  # Count occurrences of system-4 messages asking the same question
-  focus_questions = [msg for msg in state.get("messages", [])
-                    if msg.get("id") == "system-4" and "focus more on social media or search ads" in msg.get("content", "")]
+  scan = _scan_messages(state, messages)
+  user_input = state.setdefault("user_input", {})
 
   # LOWER THRESHOLD: More aggressive loop detection - end after just 2 repeated questions instead of 3
-  if len(focus_questions) > 2:
-    logger.info(f"🔄 LangGraph Flow Control: should_end - Detected {len(focus_questions)} focus questions, forcing workflow end")
+  if scan.focus_count > 2:
+    logger.info("🔄 LangGraph Flow Control: should_end - Detected %d focus questions, forcing workflow end", scan.focus_count)
     # Set a default budget if needed
-    if not state.get("user_input", {}).get("budget"):
-      state["user_input"]["budget"] = "$5000"
+    if not user_input.get("budget"):
+      user_input["budget"] = "$5000"
     # Set a default focus if needed
-    if not state.get("user_input", {}).get("focus"):
-      state["user_input"]["focus"] = "social media"
+    if not user_input.get("focus"):
+      user_input["focus"] = "social media"
     # Update stage to final
     state["current_stage"] = "final"
     return END
 
-  budget_questions = [msg for msg in state.get("messages", [])
-                      if msg.get("type") == "ai" and "budget" in msg.get("content", "").lower()]
-
   # LOWER THRESHOLD: Only allow 2 budget questions before forcing end
-  if len(budget_questions) > 2:
-    logger.info(f"🔄 LangGraph Flow Control: should_end - Detected {len(budget_questions)} budget questions, forcing workflow end")
+  if scan.budget_count > 2:
+    logger.info("🔄 LangGraph Flow Control: should_end - Detected %d budget questions, forcing workflow end", scan.budget_count)
     # Set a default budget if needed
-    if not state.get("user_input", {}).get("budget"):
-      state["user_input"]["budget"] = "$5000"
+    if not user_input.get("budget"):
+      user_input["budget"] = "$5000"
     # Set a default focus if needed
-    if not state.get("user_input", {}).get("focus"):
-      state["user_input"]["focus"] = "social media"
+    if not user_input.get("focus"):
+      user_input["focus"] = "social media"
     # Update stage to final
     state["current_stage"] = "final"
     return END
 
-  # Detect campaign start questions loop
-  campaign_questions = [msg for msg in state.get("messages", [])
-                        if msg.get("type") == "ai" and "start the marketing campaign" in msg.get("content", "")]
-
   # LOWER THRESHOLD: Only allow 2 campaign start questions
-  if len(campaign_questions) > 2:
+  if scan.campaign_count > 2:
     logger.info("🔄 LangGraph Flow Control: should_end - Detected conversation loop, ending workflow")
     # Update stage to final to ensure proper termination
     state["current_stage"] = "final"
     return END
 
   # Check if we have a message requesting the final plan
-  for message in state.get("messages", []):
-    if message.get("type") == "human" and message.get("content"):
-      content = message.get("content", "").lower()
-      if any(keyword in content for keyword in ["final plan", "generate plan", "create plan", "looks good", "satisfied"]):
-        logger.info("🔄 LangGraph Flow Control: should_end - User requested final plan, ending workflow")
-        state["current_stage"] = "final"
-        return END
+  if scan.final_plan_found:
+    logger.info("🔄 LangGraph Flow Control: should_end - User requested final plan, ending workflow")
+    state["current_stage"] = "final"
+    return END
 
   # If we have enough data to generate a plan and user confirms, end the workflow
-  has_budget = bool(state.get("user_input", {}).get("budget"))
-  has_focus = bool(state.get("user_input", {}).get("focus"))
-
-  if has_budget and has_focus and state.get("current_stage") == "refinement":
-    # Look for confirmation words in recent messages
-    for message in list(reversed(state.get("messages", [])))[:5]: # Check last 5 messages
-      if message.get("type") == "human":
-        content = message.get("content", "").lower()
-        if any(word in content for word in ["yes", "yeah", "sure", "ok", "okay", "great"]):
-          logger.info("🔄 LangGraph Flow Control: should_end - User confirmed, ending workflow")
-          state["current_stage"] = "final"
-          return END
+  has_budget = bool(user_input.get("budget"))
+  has_focus = bool(user_input.get("focus"))
+
+  if has_budget and has_focus and state.get("current_stage") == "refinement" and scan.last5_confirm:
+    logger.info("🔄 LangGraph Flow Control: should_end - User confirmed, ending workflow")
+    state["current_stage"] = "final"
+    return END
 
   logger.info("🔄 LangGraph Flow Control: should_end - Continuing workflow")
   return "continue"
@@ -99,24 +172,19 @@ def should_end(state: MarketingPlanState) -> Literal["continue", END]:
 def route_by_stage(state: MarketingPlanState) -> str:
   """Route to the next node based on the current stage."""
   current_stage = state.get("current_stage", "initial")
-  logger.info(f"🔄 LangGraph Flow Control: route_by_stage - Routing from stage: {current_stage}")
+  messages = state.get("messages") or ()
+  logger.info("🔄 LangGraph Flow Control: route_by_stage - Routing from stage: %s", current_stage)
 
   # Check for repeated questions that indicate loops
-  focus_questions = [msg for msg in state.get("messages", [])
-                    if msg.get("id") == "system-4" and "focus more on social media or search ads" in msg.get("content", "")]
-
-  budget_questions = [msg for msg in state.get("messages", [])
-                      if msg.get("type") == "ai" and "budget" in msg.get("content", "").lower()]
-
-  campaign_questions = [msg for msg in state.get("messages", [])
-                        if msg.get("type") == "ai" and "start the marketing campaign" in msg.get("content", "")]
+  scan = _scan_messages(state, messages)
 
   # If we're stuck asking the same question, force progression
-  if (len(focus_questions) > 3 and current_stage == "analysis") or len(budget_questions) > 3:
+  if (scan.focus_count > 3 and current_stage == "analysis") or scan.budget_count > 3:
     logger.info("🔄 LangGraph Flow Control: route_by_stage - Detected question loop, forcing progression")
     # Set default values if needed
-    if not state.get("user_input", {}).get("budget"):
-      state["user_input"]["budget"] = "$5000"
+    user_input = state.setdefault("user_input", {})
+    if not user_input.get("budget"):
+      user_input["budget"] = "$5000"
 
     # Force move to refinement
     if current_stage == "analysis":
@@ -125,15 +193,42 @@ def route_by_stage(state: MarketingPlanState) -> str:
       return "refinement"
 
   # If we're asking too many times about campaign start, move to final
-  if len(campaign_questions) > 3 and current_stage == "refinement":
+  if scan.campaign_count > 3 and current_stage == "refinement":
     logger.info("🔄 LangGraph Flow Control: route_by_stage - Detecting campaign question loop, forcing move to final stage")
     state["current_stage"] = "final"
     return "final"
 
   return current_stage
 
+def _route_after_final(state: MarketingPlanState) -> Literal["continue", END]:
+  """Go to delivery if the last message mentions downloading or emailing the plan."""
+  messages = state.get("messages") or ()
+  if not messages:
+    return END
+  content = (messages[-1].get("content") or "").lower()
+  return "continue" if ("download" in content or "email" in content) else END
+
+def _stage_router(next_node: str, end_node: str = END):
+  """Build a conditional-edge router that returns next_node unless should_end fires."""
+  def route(state: MarketingPlanState) -> str:
+    return next_node if should_end(state) == "continue" else end_node
+  route.__name__ = f"route_to_{next_node}"
+  return route
+
 # Define the state graph
-def build_graph():
+def build_graph(debug: Optional[bool] = None):
+  """Return the compiled workflow, compiling it at most once per debug setting.
+
+  When debug is not given, step tracing is enabled only if LANGGRAPH_DEBUG=1.
+  Tracing logs a state snapshot at every node boundary, so it is meant for
+  development only and stays off by default.
+  """
+  if debug is None:
+    debug = os.getenv("LANGGRAPH_DEBUG") == "1"
+  return _compile_graph(debug)
+
+@functools.lru_cache(maxsize=2)
+def _compile_graph(debug: bool):
   workflow = StateGraph(MarketingPlanState)
 
   # Add nodes
@@ -145,55 +240,34 @@ def build_graph():
   workflow.add_node("final", generate_final_plan)
   workflow.add_node("delivery", handle_plan_delivery) # Add new delivery node
 
-  # Add conditional edges
-  workflow.add_conditional_edges(
-    "initial",
-    should_end,
-    {
-      "continue": "data_gathering",
-      END: END
-    }
-  )
-
-  workflow.add_conditional_edges(
-    "data_gathering",
-    should_end,
-    {
-      "continue": "competitor_analysis",
-      END: END
-    }
-  )
-
-  workflow.add_conditional_edges(
-    "competitor_analysis",
-    should_end,
-    {
-      "continue": "analysis",
-      END: END
-    }
-  )
-
-  workflow.add_conditional_edges(
-    "analysis",
-    should_end,
-    {
-      "continue": "refinement",
-      END: END
-    }
-  )
+  # Add conditional edges; each router returns the next node name directly
+  for stage, next_stage in (
+    ("initial", "data_gathering"),
+    ("data_gathering", "competitor_analysis"),
+    ("competitor_analysis", "analysis"),
+    ("analysis", "refinement")
+  ):
+    workflow.add_conditional_edges(
+      stage,
+      _stage_router(next_stage),
+      {
+        next_stage: next_stage,
+        END: END
+      }
+    )
 
   workflow.add_conditional_edges(
     "refinement",
-    should_end,
+    _stage_router("refinement", end_node="final"), # When should_end fires, go to final stage
     {
-      "continue": "refinement",
-      END: "final" # When should_end returns END, go to final stage
+      "refinement": "refinement",
+      "final": "final"
     }
   )
 
   workflow.add_conditional_edges(
     "final",
-    lambda x: "continue" if "download" in x.get("messages", [])[-1].get("content", "").lower() or "email" in x.get("messages", [])[-1].get("content", "").lower() else END,
+    _route_after_final,
     {
       "continue": "delivery",
       END: END
@@ -213,5 +287,5 @@ def build_graph():
 
   logger.info("LangGraph workflow compiled with nodes: initial, data_gathering, competitor_analysis, analysis, refinement, final, delivery")
 
-  # Just use debug=True without recursion_limit since it's not supported in this version
-  return workflow.compile(debug=True) 
\ No newline at end of file
+  # recursion_limit is not supported by compile() in this version
+  return workflow.compile(debug=debug) 
\ No newline at end of file
@@ -0,0 +1,112 @@
+from typing import Any, List, Type, TypeVar
+import json
+import re
+from pydantic import BaseModel
+
+# orjson is optional; it serializes the large search-result payloads several times faster
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Both raise a ValueError subclass on malformed input
+_loads = orjson.loads if orjson is not None else json.loads
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+# Locates the JSON payload in a free-text response, skipping fences and surrounding prose
+_JSON_PAYLOAD_RE = re.compile(r"\{.*\}|\[.*\]", re.DOTALL)
+# The body of the first markdown code fence, with or without a json tag
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_CLOSERS = {"{": "}", "[": "]"}
+
+def dumps_indented(obj: Any) -> str:
+  """Serialize obj as 2-space indented JSON for embedding in prompts."""
+  if orjson is not None:
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+  return json.dumps(obj, indent=2)
+
+def robust_parse_json(content: str, schema: Type[ModelT]) -> ModelT:
+  """Validate a free-text JSON reply from an LLM against schema.
+
+  The payload is located with one regex pass and validated directly from the
+  JSON text. Raises ValueError (pydantic's ValidationError is one) if there is
+  no payload or it doesn't match schema.
+  """
+  match = _JSON_PAYLOAD_RE.search(content)
+  if match is None:
+    raise ValueError("No JSON payload found in the response")
+  return schema.model_validate_json(match.group(0))
+
+def _drop_trailing_comma(chars: List[str]) -> None:
+  while chars and chars[-1].isspace():
+    chars.pop()
+  if chars and chars[-1] == ",":
+    chars.pop()
+
+def repair_json(text: str) -> str:
+  """Fix the usual ways LLM JSON goes wrong, without another LLM call.
+
+  Text before the first bracket and after the matching closing bracket is
+  dropped, as are trailing commas and stray closing brackets. Output cut off
+  mid-value gets its open string and brackets closed.
+  """
+  starts = [pos for pos in (text.find("{"), text.find("[")) if pos != -1]
+  if not starts:
+    return text
+  chars: List[str] = []
+  stack: List[str] = []
+  in_string = escaped = False
+  for ch in text[min(starts):]:
+    if in_string:
+      chars.append(ch)
+      if escaped:
+        escaped = False
+      elif ch == "\\":
+        escaped = True
+      elif ch == '"':
+        in_string = False
+      continue
+    if ch in "}]":
+      if not stack or stack[-1] != ch:
+        continue
+      _drop_trailing_comma(chars)
+      chars.append(stack.pop())
+      if not stack:
+        break
+      continue
+    if ch in _CLOSERS:
+      stack.append(_CLOSERS[ch])
+    elif ch == '"':
+      in_string = True
+    chars.append(ch)
+
+  # Close whatever the truncated output left open
+  if in_string:
+    chars.append('"')
+  _drop_trailing_comma(chars)
+  if chars and chars[-1] == ":":
+    chars.append("null")
+  while stack:
+    _drop_trailing_comma(chars)
+    chars.append(stack.pop())
+  return "".join(chars)
+
+def loads_lenient(content: str) -> Any:
+  """Parse a free-text JSON reply from an LLM, repairing it locally if needed.
+
+  The reply is tried as-is, then the body of its code fence, then repaired
+  with repair_json.
+  """
+  try:
+    return _loads(content)
+  except ValueError:
+    pass
+  fence = _CODE_FENCE_RE.search(content)
+  if fence is not None:
+    content = fence.group(1)
+    try:
+      return _loads(content)
+    except ValueError:
+      pass
+  return _loads(repair_json(content))
@@ -0,0 +1,82 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_openai import ChatOpenAI
+import functools
+import hashlib
+import httpx
+import os
+import threading
+
+# Model for short classifications and one-line replies, where gpt-4o adds latency but no quality
+SMALL_MODEL = "gpt-4o-mini"
+
+# Rate-limit, timeout and 5xx errors are retried by the OpenAI client with exponential backoff
+_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+
+# Process-wide limits shared by every client and every session, so concurrent sessions queue here
+# instead of hitting 429s. The httpx pool caps requests in flight at MAX_CONCURRENT_LLM; the rate
+# limiter starts at most LLM_REQUESTS_PER_SECOND across the whole process, bursting up to
+# MAX_CONCURRENT_LLM after an idle spell. The default of 3/s (180 per minute) stays under OpenAI's
+# lowest paid-tier request limits; raise it for higher account tiers.
+_MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_LLM", "8"))
+_REQUESTS_PER_SECOND = float(os.getenv("LLM_REQUESTS_PER_SECOND", "3"))
+_rate_limiter = InMemoryRateLimiter(
+  requests_per_second=_REQUESTS_PER_SECOND,
+  max_bucket_size=_MAX_CONCURRENT_REQUESTS
+)
+_http_client = httpx.Client(limits=httpx.Limits(
+  max_connections=_MAX_CONCURRENT_REQUESTS,
+  max_keepalive_connections=_MAX_CONCURRENT_REQUESTS
+))
+
+# Worker threads for LLM calls that can overlap with other work in the same node
+_LLM_WORKERS = 4
+_executor = ThreadPoolExecutor(max_workers=_LLM_WORKERS, thread_name_prefix="llm")
+
+# Replies to temperature-0 prompts keyed by a digest of the model name and prompt
+_RESPONSE_CACHE_MAX_ENTRIES = 256
+_response_cache: Dict[str, str] = {}
+_response_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_llm(model: str = "gpt-4o", temperature: float = 0) -> ChatOpenAI:
+  """Return the shared ChatOpenAI client for a model and temperature.
+
+  Clients are created on first use rather than at import time, so the API key
+  from .env is loaded by then. Reusing a client keeps its HTTP connection pool
+  alive between calls. All clients share one connection pool and rate limiter,
+  which cap the LLM traffic of the whole process.
+  """
+  return ChatOpenAI(
+    model=model,
+    temperature=temperature,
+    max_retries=_MAX_RETRIES,
+    rate_limiter=_rate_limiter,
+    http_client=_http_client
+  )
+
+def cached_invoke(llm: ChatOpenAI, prompt: str) -> str:
+  """Return the reply text for prompt, reusing earlier replies from deterministic clients.
+
+  Only clients with temperature 0 are cached; anything else is always sent to the API.
+  """
+  if llm.temperature:
+    return llm.invoke(prompt).content
+
+  key = hashlib.blake2b(f"{llm.model_name}\0{prompt}".encode(), digest_size=16).hexdigest()
+  with _response_cache_lock:
+    cached = _response_cache.get(key)
+  if cached is not None:
+    return cached
+
+  content = llm.invoke(prompt).content
+  with _response_cache_lock:
+    if len(_response_cache) >= _RESPONSE_CACHE_MAX_ENTRIES:
+      _response_cache.pop(next(iter(_response_cache)), None)
+    _response_cache[key] = content
+  return content
+
+def invoke_in_background(llm: ChatOpenAI, prompt: str) -> Future:
+  """Start cached_invoke(llm, prompt) on a worker thread and return its future."""
+  return _executor.submit(cached_invoke, llm, prompt)
@@ -1,18 +1,22 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
+import copy
+import functools
 import os
+import re
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
+import httpx
 import logging
-import uuid
+import openai
 
 # Import modularized components
-from .agent_state import MarketingPlanState
+from .agent_state import MarketingPlanState, GreetingVerdict, has_message_id, new_message_id, sync_message_index
 # WebsiteAnalysisTool is not directly used here anymore, but it's part of the agent's tools conceptually.
 # from .agent_tools import WebsiteAnalysisTool 
 from .response_analyzer import analyze_user_response
 # Import only the node functions directly called by on_message, others are managed by the graph.
-from .graph_nodes import extract_business_data, generate_final_plan 
+from .graph_nodes import URL_RE, extract_business_data, generate_final_plan
 from .graph_logic import build_graph
+from .llm_client import SMALL_MODEL, cached_invoke, get_llm
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,51 +29,246 @@ load_dotenv()
 os.environ["TAVILY_API_KEY"] = os.getenv("TAVILY_API_KEY", "")
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY", "")
 
-# Create the agent by building the graph
-marketing_agent = build_graph()
+@functools.lru_cache(maxsize=None)
+def get_agent():
+  """Return the compiled LangGraph agent, building it on first use.
+
+  The graph is compiled once per process and reused for every message.
+  """
+  return build_graph()
+
+# Values for any state keys a new session does not have yet
+_DEFAULT_STATE: Dict[str, Any] = {
+  "messages": [],
+  "business_info": {},
+  "competitor_info": [],
+  "marketing_channels": [],
+  "budget_allocation": {},
+  "ad_creatives": [],
+  "user_input": {},
+  "current_stage": "initial"
+}
+
+# Prompt templates for the replies on_message writes itself, filled with format_map
+_BUDGET_ACK_TEMPLATE = """
+Generate a friendly, conversational response to acknowledge the user's marketing budget and ask about their marketing focus preference.
+
+Budget: {budget_display} {currency} ({period})
+Industry: {industry}
+
+Your response should:
+1. Acknowledge the budget accurately (be especially careful with Indian currency formats like crores and lakhs)
+2. Ask if they want to focus more on social media marketing, search ads, or have a balanced approach
+3. Be specific to their industry if possible
+
+Keep your response natural, concise, and friendly.
+"""
+
+_INSTAGRAM_QUESTION_TEMPLATE = """
+Generate a personalized question asking if the user would like to allocate a larger portion of their budget to Instagram ads.
+
+Consider these details:
+- Their business is in the {industry} industry
+- Their budget is {budget}
+- They mentioned these platforms: {mentioned_platforms}
+- They have these marketing goals: {marketing_goals}
+
+Make your question conversational, specific to their industry, and reference any relevant platforms or goals they mentioned.
+"""
+
+_START_DATE_QUESTION_TEMPLATE = """
+Generate a personalized question asking when the user would like to start their marketing campaign.
+This is the final piece of information needed before I can generate the marketing plan.
+
+Consider these details:
+- Their business is in the {industry} industry
+- Their budget is {budget}
+- Their focus is on {focus}
+- They mentioned these platforms: {mentioned_platforms}
+- They have these marketing goals: {marketing_goals}
+
+Make your question conversational and specific to their industry, referencing any relevant platforms or goals they mentioned.
+Clearly indicate that providing the start date will allow you to proceed with generating the plan.
+For example: "Okay, we're almost ready! Just let me know when you'd like to start the campaign for your {industry} business, and I can draft your marketing plan."
+"""
+
+_FOCUS_CLARIFICATION_TEMPLATE = """
+Generate a friendly message asking the user to clarify their marketing focus preference.
+
+The message should:
+1. Acknowledge that you're not sure what they prefer
+2. Clearly present the three options: social media marketing, search ads, or a balanced approach
+3. Be conversational and helpful
+4. Be specific to their {industry} industry if possible
+
+Keep it brief but clear.
+"""
+
+_INSTAGRAM_FOLLOWUP_TEMPLATE = """
+Generate a conversational question asking when the user would like to start their marketing campaign.
+This is the final piece of information needed before I can generate the marketing plan.
+
+Consider:
+- Their business is in the {industry} industry
+- They {instagram_stance} to focus heavily on Instagram ads.
+- Their budget is {budget}
+
+If they mentioned concerns about Instagram ads or suggested alternative platforms, acknowledge that briefly.
+Make your question specific to their industry if possible, keeping it brief and friendly.
+Clearly indicate that providing the start date will allow you to proceed with generating the plan.
+For example: "Got it. One last thing: when would you like to start the campaign for your {industry} business? Once I have that, I can prepare your marketing plan."
+"""
+
+# STEP 6 replies while waiting for the start date, keyed by
+# (start date provided, duration provided, bare affirmative); filled from user_input
+_READY_TO_GENERATE_REPLY = "Great! We'll set the campaign to start {start_date} and run for {campaign_duration}. Are you ready to generate the final marketing plan now?"
+_START_DATE_STEP_REPLIES = {
+  (True, True, False): _READY_TO_GENERATE_REPLY,
+  (True, False, False): "Okay, campaign start is set for {start_date}. How long should the campaign run (e.g., '3 months', '6 weeks')?",
+  (False, True, False): "Got the campaign duration as {campaign_duration}. When should the campaign start? Please provide a specific date or timeframe.",
+  (False, False, True): "I understand you're ready to set a start date. Could you please provide a specific date or timeframe (e.g., 'next Monday', 'July 1st', 'in two weeks')?",
+  (False, False, False): "When would you like to start the campaign? Please provide a date or timeframe (e.g., 'next Monday', 'July 1st', 'in two weeks')."
+}
+
+# Plan parameters collected again when the user modifies a generated plan:
+# (user_input key, plan_modification_request analysis key, name when noted, phrase when missing)
+_MOD_FIELDS = (
+  ("budget", "new_budget_original_format", "budget", "the new budget"),
+  ("start_date", "new_start_date", "start date", "the new campaign start date"),
+  ("campaign_duration", "new_campaign_duration", "campaign duration", "the new campaign duration")
+)
+
+# "the new budget, and the new campaign duration" etc., indexed by a bitmask of
+# missing fields (bit i set when _MOD_FIELDS[i] is missing)
+_MISSING_PARTS_TEXT = tuple(
+  ", and ".join(field[3] for position, field in enumerate(_MOD_FIELDS) if mask >> position & 1)
+  for mask in range(1 << len(_MOD_FIELDS))
+)
+
+# Replies while plan modifications are collected; the regenerate replies are filled from user_input
+_MOD_NOTED_TEMPLATE = "I've noted your request for {noted}. "
+_MOD_MISSING_REPLY = "Okay, you'd like to refine the plan. {noted}To regenerate the plan, please also provide {missing}."
+_MOD_STILL_MISSING_REPLY = "Thanks for that information. To regenerate the plan, I still need you to provide {missing}."
+_MOD_REGENERATE_REPLY = "Great! I'll regenerate the plan with the updated budget: {budget}, start date: {start_date}, and campaign duration: {campaign_duration}. Generating now..."
+_MOD_COLLECTED_REPLY = "Excellent, all details received! I'll regenerate the plan with the budget: {budget}, start date: {start_date}, and campaign duration: {campaign_duration}. Generating now..."
+
+def _set_budget_details(user_input: Dict[str, Any], analysis: Dict[str, Any]) -> None:
+  """Copy the value and currency of a new budget from a plan_modification_request analysis."""
+  user_input["budget_value"] = analysis.get("new_budget_converted_standard_value") or analysis.get("new_budget_amount")
+  user_input["currency"] = analysis.get("new_budget_currency", user_input.get("currency_default", "USD")) # Keep a default or previous if any
+  user_input["currency_symbol"] = analysis.get("new_budget_currency_symbol", user_input.get("currency_symbol_default", "$"))
+
+def _apply_modification_update(user_input: Dict[str, Any], analysis: Dict[str, Any]) -> Tuple[int, List[Tuple[str, Any]]]:
+  """Fill still-missing plan parameters from a plan_modification_request analysis.
+
+  Returns a bitmask of the _MOD_FIELDS that are still missing (see
+  _MISSING_PARTS_TEXT) and the (name, value) pairs set by this call.
+  """
+  missing_mask = 0
+  updated = []
+  for position, (input_key, analysis_key, name, _) in enumerate(_MOD_FIELDS):
+    if not user_input.get(input_key) and analysis.get(analysis_key):
+      user_input[input_key] = analysis[analysis_key]
+      if input_key == "budget":
+        _set_budget_details(user_input, analysis)
+      updated.append((name, analysis[analysis_key]))
+    if not user_input.get(input_key):
+      missing_mask |= 1 << position
+  return missing_mask, updated
+
+# Failures expected from plan generation: API and network errors, timeouts, and malformed or
+# incomplete model output. Anything else is a bug and goes to on_message's general handler
+_PLAN_ERRORS = (openai.OpenAIError, httpx.HTTPError, TimeoutError, KeyError, ValueError)
+
+def _regenerate_modified_plan(state: MarketingPlanState, confirmation_message: str, log_prefix: str) -> MarketingPlanState:
+  """Confirm the collected modifications and regenerate the plan, reverting to 'final' if that fails."""
+  previous_plan = (state["marketing_channels"], state["budget_allocation"], state["ad_creatives"])
+  state["marketing_channels"] = [] # Clear plan components for regeneration
+  state["budget_allocation"] = {}
+  state["ad_creatives"] = []
+  state["messages"].append({"id": new_message_id(), "type": "ai", "content": confirmation_message})
+  state["current_stage"] = "refinement"
+  logger.info("%s: All details provided. Set stage to 'refinement' for plan regeneration.", log_prefix)
+  try:
+    return generate_final_plan(state)
+  except _PLAN_ERRORS as e:
+    logger.error("%s: Error regenerating final plan: %s", log_prefix, e)
+    _restore_plan(state, previous_plan)
+    state["messages"].append({"id": new_message_id(), "type": "ai", "content": "I encountered an error while trying to regenerate your plan. Please try describing your changes again."})
+    return state
+  except Exception:
+    # Unexpected errors go to on_message's general handler, but the session keeps its previous plan
+    _restore_plan(state, previous_plan)
+    raise
+
+def _restore_plan(state: MarketingPlanState, previous_plan: Tuple[list, dict, list]) -> None:
+  """Put back the plan that was cleared for regeneration and revert to the 'final' stage."""
+  state["marketing_channels"], state["budget_allocation"], state["ad_creatives"] = previous_plan
+  state["current_stage"] = "final"
+
+# Plain greetings are recognized locally; anything else is classified by the LLM
+_GREETING_RE = re.compile(
+  r"^\s*(hi|hello|hey|hey there|hiya|yo|good (morning|afternoon|evening)|greetings)[\s!.,?]*$",
+  re.IGNORECASE
+)
+
+@functools.lru_cache(maxsize=1024)
+def _is_greeting_llm(normalized_message: str) -> bool:
+  """Ask the LLM whether a message is only a greeting; answers are cached per normalized message."""
+  greeting_prompt = f"""
+  Analyze this user message: "{normalized_message}"
+  
+  Is this a greeting or introduction without any specific business URL?
+  """
+  classifier = get_llm(SMALL_MODEL).with_structured_output(GreetingVerdict, method="function_calling")
+  return classifier.invoke(greeting_prompt).is_greeting
+
+# After a plan is delivered, short unambiguous replies are classified locally; the whole
+# message must match, so anything with more to it ("looks good, but...") goes to the LLM
+_PLAN_REPLY_RE = re.compile(
+  r"^\s*(?:(?P<happy>yes|yep|yeah|perfect|great|looks (?:good|great)|all good|no changes(?: needed)?|"
+  r"(?:i'?m |i am )?happy with (?:it|this|the plan))|"
+  r"(?P<send>download(?: it| the plan)?|email(?: it)?(?: to me)?|email me the plan|send (?:it|me the plan)))"
+  r"[\s!.,]*$",
+  re.IGNORECASE
+)
+
+def _quick_plan_reply_analysis(message_content: str) -> Optional[Dict[str, Any]]:
+  """Return a plan_modification_request analysis for a trivially classifiable reply, or None."""
+  match = _PLAN_REPLY_RE.match(message_content)
+  if match is None:
+    return None
+  return {
+    "wants_budget_change": False,
+    "wants_timeline_change": False,
+    "confirmed_happy_with_plan": match.group("happy") is not None,
+    "requested_download_or_email": match.group("send") is not None
+  }
 
 # Update the on_message function to use intelligent analysis for each stage
-def on_message(state: MarketingPlanState, message: Dict[str, Any]):
+def on_message(state: MarketingPlanState, message: Dict[str, Any]) -> MarketingPlanState:
   """Process new messages based on current conversation stage"""
   try:
-    # Initialize state if needed
-    if "messages" not in state:
-      state["messages"] = []
-
-    if "business_info" not in state:
-      state["business_info"] = {}
-
-    if "competitor_info" not in state:
-      state["competitor_info"] = []
-
-    if "marketing_channels" not in state:
-      state["marketing_channels"] = []
-
-    if "budget_allocation" not in state:
-      state["budget_allocation"] = {}
+    # Initialize state if needed; defaults are copied so sessions never share a list or dict
+    for key, default in _DEFAULT_STATE.items():
+      if key not in state:
+        state[key] = copy.copy(default)
 
-    if "ad_creatives" not in state:
-      state["ad_creatives"] = []
-
-    if "user_input" not in state:
-      state["user_input"] = {}
-
-    if "current_stage" not in state:
-      state["current_stage"] = "initial"
+    # Bound once for the stages below; user_input is updated in place
+    user_input = state["user_input"]
+    industry = state["business_info"].get("industry", "")
 
     # Get the message content and ID
     message_content = message.get("content", "")
-    message_id = message.get("id", str(uuid.uuid4()))
+    message_id = message["id"] if "id" in message else new_message_id()
 
-    logger.info(f"Processing message (ID: {message_id}) in stage: {state['current_stage']}")
-    logger.info(f"Message content: '{message_content[:100]}...' if len(message_content) > 100 else message_content")
+    logger.info("Processing message (ID: %s) in stage: %s", message_id, state["current_stage"])
+    logger.info("Message content: %s", message_content if len(message_content) <= 100 else message_content[:100] + "...")
 
     # Check if this message ID already exists to prevent duplicates
-    existing_ids = [msg.get("id") for msg in state["messages"]]
-
-    if message_id not in existing_ids:
+    if not has_message_id(state, message_id):
       # Add the user message to the state
-      logger.info(f"Adding user message with ID {message_id} to state")
+      logger.info("Adding user message with ID %s to state", message_id)
       state["messages"].append({
         "id": message_id,
         "type": "human",
@@ -77,65 +276,56 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
       })
 
       # For first message with URL, ensure we provide a clear AI response
-      if state["current_stage"] == "initial" and "http" in message_content and "." in message_content:
+      if state["current_stage"] == "initial" and URL_RE.search(message_content):
         # Store the URL in user_input
-        state["user_input"]["website"] = message_content
-        logger.info(f"Stored URL in user_input: {message_content}")
+        user_input["website"] = message_content
+        logger.info("Stored URL in user_input: %s", message_content)
     else:
-      logger.info(f"Message with ID {message_id} already exists in state, skipping addition")
+      logger.info("Message with ID %s already exists in state, skipping addition", message_id)
 
     # First check if this is just a greeting message with no URL
-    ai_messages = [msg for msg in state.get("messages", []) if msg.get("type") == "ai"]
-    last_ai_message = ai_messages[-1] if ai_messages else None
+    # Lowercased once here; every stage check below matches against this copy
+    last_ai_idx = sync_message_index(state)["last_ai_idx"]
+    last_ai_message = state["messages"][last_ai_idx] if last_ai_idx is not None else None
     last_ai_content = last_ai_message.get("content", "").lower() if last_ai_message else ""
 
     # Get greeting intent using intelligent analysis
-    if state["current_stage"] == "initial" and not "http" in message_content:
-      llm = ChatOpenAI(model="gpt-4o", temperature=0)
-      greeting_prompt = f"""
-      Analyze this user message: "{message_content}"
-      
-      Is this a greeting or introduction without any specific business URL?
-      Return "yes" if it's just a greeting, or "no" if it contains substantive information.
-      ONLY return "yes" or "no".
-      """
-
+    if state["current_stage"] == "initial" and not URL_RE.search(message_content):
       try:
-        greeting_result = llm.invoke(greeting_prompt)
-        is_greeting = greeting_result.content.strip().lower() == "yes"
+        is_greeting = _GREETING_RE.match(message_content) is not None or _is_greeting_llm(message_content.strip().lower())
 
         if is_greeting:
           # Respond with a welcome message and ask for the URL
           welcome_response = {
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": "Hello! Welcome to the Marketing Media Plan Generator. Please provide your business website URL to analyze (starting with http:// or https://)."
           }
-          logger.info(f"Adding welcome response: {welcome_response['id']}")
+          logger.info("Adding welcome response: %s", welcome_response["id"])
           state["messages"].append(welcome_response)
           logger.info("Handled greeting message, requesting URL")
           return state
-      except:
+      except Exception as e:
         # If analysis fails, continue with normal flow
-        pass
+        logger.warning("Greeting check failed, continuing with the normal flow: %s", e)
 
     # Follow a conversation flow based on the current stage and user messages
 
     # STEP 1: Extract Business URL and Industry Confirmation
-    if state["current_stage"] == "initial" and "http" in message_content:
+    if state["current_stage"] == "initial" and URL_RE.search(message_content):
       # Process the URL using extract_business_data directly
       return extract_business_data(state)
 
     # STEP 2: Confirm Industry and Move to Budget Question
     if state["current_stage"] == "data_gathering":
       # Use intelligent analysis to determine if the user confirmed their industry
-      context_info = {"industry": state.get("business_info", {}).get("industry", "")}
+      context_info = {"industry": industry}
       analysis = analyze_user_response(message_content, context_info, "industry_confirmation")
 
       if analysis.get("confirmed", False):
         # User confirmed their industry, ask for monthly budget
         state["messages"].append({
-          "id": str(uuid.uuid4()),
+          "id": new_message_id(),
           "type": "ai",
           "content": "What is your monthly budget for marketing?"
         })
@@ -145,7 +335,7 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
         # User provided a different industry, update it and confirm
         state["business_info"]["industry"] = analysis.get("corrected_industry")
         state["messages"].append({
-          "id": str(uuid.uuid4()),
+          "id": new_message_id(),
           "type": "ai",
           "content": f"Thank you for the correction. So your business is in the {analysis.get('corrected_industry')} industry. What is your monthly budget for marketing?"
         })
@@ -154,16 +344,16 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
       else:
         # User's response was unclear, ask for clarification
         state["messages"].append({
-          "id": str(uuid.uuid4()),
+          "id": new_message_id(),
           "type": "ai",
           "content": "I'm not sure if I understood correctly. Could you confirm what industry your business is in?"
         })
         return state
 
     # STEP 3: Process Budget Information
-    if state["current_stage"] == "analysis" and not state.get("user_input", {}).get("budget"):
+    if state["current_stage"] == "analysis" and not user_input.get("budget"):
       # Use intelligent analysis to extract budget information
-      context_info = {"industry": state.get("business_info", {}).get("industry", "")}
+      context_info = {"industry": industry}
       analysis = analyze_user_response(message_content, context_info, "budget_extraction")
 
       if analysis.get("amount"):
@@ -171,7 +361,8 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
         currency_symbol = analysis.get("currency_symbol", "$")
 
         # Handle Indian currency format specially
-        if "crore" in analysis.get("original_format", "").lower() or "lakh" in analysis.get("original_format", "").lower():
+        original_format = analysis.get("original_format", "").lower()
+        if "crore" in original_format or "lakh" in original_format:
           # Use the original format in displayed budget to maintain cultural context
           budget_display = analysis.get("original_format", "")
           # Store the converted standard value for calculations
@@ -184,40 +375,34 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
         currency = analysis.get("currency", "dollars")
 
         # Store the budget information
-        state["user_input"]["budget"] = budget_display
-        state["user_input"]["budget_value"] = budget_value # Store numerical value for calculations
-        state["user_input"]["currency"] = currency
-        state["user_input"]["currency_symbol"] = currency_symbol
-        logger.info(f"Extracted budget: {budget_display} ({currency})")
+        user_input["budget"] = budget_display
+        user_input["budget_value"] = budget_value # Store numerical value for calculations
+        user_input["currency"] = currency
+        user_input["currency_symbol"] = currency_symbol
+        logger.info("Extracted budget: %s (%s)", budget_display, currency)
 
         # Generate a personalized response based on the industry and budget
-        llm = ChatOpenAI(model="gpt-4o", temperature=0)
-        response_prompt = f"""
-        Generate a friendly, conversational response to acknowledge the user's marketing budget and ask about their marketing focus preference.
-        
-        Budget: {budget_display} {currency} ({analysis.get('period', 'monthly')})
-        Industry: {state.get("business_info", {}).get("industry", "")}
-        
-        Your response should:
-        1. Acknowledge the budget accurately (be especially careful with Indian currency formats like crores and lakhs)
-        2. Ask if they want to focus more on social media marketing, search ads, or have a balanced approach
-        3. Be specific to their industry if possible
-        
-        Keep your response natural, concise, and friendly.
-        """
+        llm = get_llm(SMALL_MODEL)
+        response_prompt = _BUDGET_ACK_TEMPLATE.format_map({
+          "budget_display": budget_display,
+          "currency": currency,
+          "period": analysis.get("period", "monthly"),
+          "industry": industry
+        })
 
         try:
-          response_result = llm.invoke(response_prompt)
+          response_content = cached_invoke(llm, response_prompt)
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
-            "content": response_result.content.strip()
+            "content": response_content.strip()
           })
-        except:
+        except Exception as e:
+          logger.warning("Reply generation failed, using the fallback message: %s", e)
           # Fallback to a simple response
-          budget_message_display = state["user_input"]["budget"]
+          budget_message_display = user_input["budget"]
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": f"Great! I'll plan with a budget of {budget_message_display}. Would you like to focus more on social media or search ads?"
           })
@@ -227,7 +412,7 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
       else:
         # Couldn't extract a budget, ask for clarification
         state["messages"].append({
-          "id": str(uuid.uuid4()),
+          "id": new_message_id(),
           "type": "ai",
           "content": "I couldn't understand the budget amount. Could you please provide your monthly marketing budget? For example, '$5000', '₹50,000', '₹10 lakhs', or '₹2 crores'."
         })
@@ -235,11 +420,11 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
 
     # STEP 4: Process Marketing Focus Preference (social media, search ads, or both)
     # This is still part of the 'analysis' stage if budget is set but focus is not.
-    if state["current_stage"] == "analysis" and state.get("user_input", {}).get("budget") and not state.get("user_input", {}).get("focus"):
+    if state["current_stage"] == "analysis" and user_input.get("budget") and not user_input.get("focus"):
       # Use intelligent analysis to determine marketing focus preference
       context_info = {
-        "industry": state.get("business_info", {}).get("industry", ""),
-        "budget": state.get("user_input", {}).get("budget", "")
+        "industry": industry,
+        "budget": user_input.get("budget", "")
       }
       analysis = analyze_user_response(message_content, context_info, "marketing_focus")
 
@@ -251,109 +436,88 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
           "balanced": "balanced"
         }
         user_preference = focus_map[analysis.get("primary_focus")]
-        logger.info(f"Determined user focus preference: {user_preference} with confidence {analysis.get('confidence')}")
+        logger.info("Determined user focus preference: %s with confidence %s", user_preference, analysis.get("confidence"))
 
         # Store the focus preference
-        state["user_input"]["focus"] = user_preference
+        user_input["focus"] = user_preference
 
         # Also store any specific platforms or goals mentioned for later use
         if analysis.get("mentioned_platforms"):
-          state["user_input"]["mentioned_platforms"] = analysis.get("mentioned_platforms")
+          user_input["mentioned_platforms"] = analysis.get("mentioned_platforms")
 
         if analysis.get("marketing_goals"):
-          state["user_input"]["marketing_goals"] = analysis.get("marketing_goals")
+          user_input["marketing_goals"] = analysis.get("marketing_goals")
 
         # Generate a personalized follow-up based on their focus preference
-        llm = ChatOpenAI(model="gpt-4o", temperature=0)
+        llm = get_llm(SMALL_MODEL)
+        prompt_vars = {
+          "industry": industry,
+          "budget": user_input.get("budget", ""),
+          "focus": user_preference,
+          "mentioned_platforms": analysis.get("mentioned_platforms", []),
+          "marketing_goals": analysis.get("marketing_goals", [])
+        }
 
         if user_preference == "social media":
           # For social media focus, ask about Instagram in a way relevant to their industry
-          prompt = f"""
-          Generate a personalized question asking if the user would like to allocate a larger portion of their budget to Instagram ads.
-          
-          Consider these details:
-          - Their business is in the {state.get("business_info", {}).get("industry", "")} industry
-          - Their budget is {state.get("user_input", {}).get("budget", "")}
-          - They mentioned these platforms: {analysis.get("mentioned_platforms", [])}
-          - They have these marketing goals: {analysis.get("marketing_goals", [])}
-          
-          Make your question conversational, specific to their industry, and reference any relevant platforms or goals they mentioned.
-          """
+          prompt = _INSTAGRAM_QUESTION_TEMPLATE.format_map(prompt_vars)
 
           try:
-            response = llm.invoke(prompt)
+            response_content = cached_invoke(llm, prompt)
             state["messages"].append({
-              "id": str(uuid.uuid4()),
+              "id": new_message_id(),
               "type": "ai",
-              "content": response.content.strip()
+              "content": response_content.strip()
             })
-          except:
+          except Exception as e:
+            logger.warning("Reply generation failed, using the fallback message: %s", e)
             # Fallback to a standard question
             state["messages"].append({
-              "id": str(uuid.uuid4()),
+              "id": new_message_id(),
               "type": "ai",
               "content": "Would you like to allocate a larger portion of your budget to Instagram ads?"
             })
         else:
           # For search ads or balanced approach, ask about campaign start date
-          prompt = f"""
-          Generate a personalized question asking when the user would like to start their marketing campaign.
-          This is the final piece of information needed before I can generate the marketing plan.
-          
-          Consider these details:
-          - Their business is in the {state.get("business_info", {}).get("industry", "")} industry
-          - Their budget is {state.get("user_input", {}).get("budget", "")}
-          - Their focus is on {user_preference}
-          - They mentioned these platforms: {analysis.get("mentioned_platforms", [])}
-          - They have these marketing goals: {analysis.get("marketing_goals", [])}
-          
-          Make your question conversational and specific to their industry, referencing any relevant platforms or goals they mentioned.
-          Clearly indicate that providing the start date will allow you to proceed with generating the plan.
-          For example: "Okay, we're almost ready! Just let me know when you'd like to start the campaign for your {state.get("business_info", {}).get("industry", "")} business, and I can draft your marketing plan."
-          """
+          prompt = _START_DATE_QUESTION_TEMPLATE.format_map(prompt_vars)
 
           try:
-            response = llm.invoke(prompt)
+            response_content = cached_invoke(llm, prompt)
             state["messages"].append({
-              "id": str(uuid.uuid4()),
+              "id": new_message_id(),
               "type": "ai",
-              "content": response.content.strip()
+              "content": response_content.strip()
             })
-          except:
+          except Exception as e:
+            logger.warning("Reply generation failed, using the fallback message: %s", e)
             # Fallback to a standard question
             state["messages"].append({
-              "id": str(uuid.uuid4()),
+              "id": new_message_id(),
               "type": "ai",
               "content": "When would you like to start your marketing campaign?"
             })
         state["current_stage"] = "refinement" # Move to refinement stage
         return state
       else:
-        # If analysis is uncertain, ask for clarification
-        llm = ChatOpenAI(model="gpt-4o", temperature=0)
-        prompt = f"""
-        Generate a friendly message asking the user to clarify their marketing focus preference.
-        
-        The message should:
-        1. Acknowledge that you're not sure what they prefer
-        2. Clearly present the three options: social media marketing, search ads, or a balanced approach
-        3. Be conversational and helpful
-        4. Be specific to their {state.get("business_info", {}).get("industry", "")} industry if possible
-        
-        Keep it brief but clear.
-        """
+        # If analysis is uncertain, ask for clarification; the prompt depends only on the
+        # industry, so repeated clarifications are served from the response cache
+        llm = get_llm(SMALL_MODEL)
+        prompt = _FOCUS_CLARIFICATION_TEMPLATE.format_map({
+          "industry": industry
+        })
 
         try:
-          response = llm.invoke(prompt)
+          response_content = cached_invoke(llm, prompt)
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
-            "content": response.content.strip()
+            "content": response_content.strip()
           })
-        except:
+        except Exception as e:
+          logger.warning("Reply generation failed, using the fallback message: %s", e)
           # Fallback to a standard clarification request
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": "I'm not sure I understood your preference. Could you clarify if you'd like to focus on social media marketing, search ads, or would prefer a balanced approach with both?"
           })
@@ -362,13 +526,13 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
     # STEP 5: Process Instagram budget allocation (if social media focus)
     # This is the 'refinement' stage
     if state["current_stage"] == "refinement" and \
-       ("allocate a larger portion" in last_ai_content.lower() and "instagram ads" in last_ai_content.lower()) and \
-       state.get("user_input", {}).get("focus") == "social media" and \
-       not state.get("user_input", {}).get("start_date"):
+       ("allocate a larger portion" in last_ai_content and "instagram ads" in last_ai_content) and \
+       user_input.get("focus") == "social media" and \
+       not user_input.get("start_date"):
       # Use intelligent analysis to understand Instagram allocation preference
       context_info = {
-        "industry": state.get("business_info", {}).get("industry", ""),
-        "budget": state.get("user_input", {}).get("budget", "")
+        "industry": industry,
+        "budget": user_input.get("budget", "")
       }
       analysis = analyze_user_response(message_content, context_info, "instagram_allocation")
 
@@ -381,7 +545,7 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
         # Use the specific percentage if provided, otherwise default to 50%
         instagram_percentage = analysis.get("specified_percentage", 50)
         state["budget_allocation"]["Instagram Ads"] = instagram_percentage
-        logger.info(f"Setting Instagram budget allocation to {instagram_percentage}%")
+        logger.info("Setting Instagram budget allocation to %s%%", instagram_percentage)
 
       # If they suggested an alternative platform, note it
       if analysis.get("alternative_platform"):
@@ -389,36 +553,28 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
           state["budget_allocation"] = {}
         # Assign a default percentage if not specified, or adjust existing
         state["budget_allocation"][analysis.get("alternative_platform")] = state["budget_allocation"].get(analysis.get("alternative_platform"), 40)
-        logger.info(f"Noted alternative platform: {analysis.get('alternative_platform')}")
+        logger.info("Noted alternative platform: %s", analysis.get("alternative_platform"))
 
       # Generate a personalized question about campaign start date
-      llm = ChatOpenAI(model="gpt-4o", temperature=0)
-      prompt = f"""
-      Generate a conversational question asking when the user would like to start their marketing campaign.
-      This is the final piece of information needed before I can generate the marketing plan.
-      
-      Consider:
-      - Their business is in the {state.get("business_info", {}).get("industry", "")} industry
-      - They {'want' if analysis.get("increase_instagram", False) else "don't necessarily want"} to focus heavily on Instagram ads.
-      - Their budget is {state.get("user_input", {}).get("budget", "")}
-      
-      If they mentioned concerns about Instagram ads or suggested alternative platforms, acknowledge that briefly.
-      Make your question specific to their industry if possible, keeping it brief and friendly.
-      Clearly indicate that providing the start date will allow you to proceed with generating the plan.
-      For example: "Got it. One last thing: when would you like to start the campaign for your {state.get("business_info", {}).get("industry", "")} business? Once I have that, I can prepare your marketing plan."
-      """
+      llm = get_llm(SMALL_MODEL)
+      prompt = _INSTAGRAM_FOLLOWUP_TEMPLATE.format_map({
+        "industry": industry,
+        "instagram_stance": "want" if analysis.get("increase_instagram", False) else "don't necessarily want",
+        "budget": user_input.get("budget", "")
+      })
 
       try:
-        response = llm.invoke(prompt)
+        response_content = cached_invoke(llm, prompt)
         state["messages"].append({
-          "id": str(uuid.uuid4()),
+          "id": new_message_id(),
           "type": "ai",
-          "content": response.content.strip()
+          "content": response_content.strip()
         })
-      except:
+      except Exception as e:
+        logger.warning("Reply generation failed, using the fallback message: %s", e)
         # Fallback to a standard question
         state["messages"].append({
-          "id": str(uuid.uuid4()),
+          "id": new_message_id(),
           "type": "ai",
           "content": "When would you like to start your marketing campaign?"
         })
@@ -427,7 +583,7 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
     # STEP 6: Gather Campaign Start Date and Duration (Refinement Stage)
     if state["current_stage"] == "refinement":
       # Check if we are waiting for the start date
-      if not state.get("user_input", {}).get("start_date"):
+      if not user_input.get("start_date"):
         logger.info("STEP 6: Waiting for campaign start date.")
         analysis_context = {"current_stage": "refinement"} 
         analysis = analyze_user_response(message_content, analysis_context, "campaign_start_date")
@@ -436,51 +592,27 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
         provided_start_date = analysis.get("specific_date") or analysis.get("relative_timeframe") or analysis.get("seasonal_timing")
         provided_duration = analysis.get("campaign_duration")
 
-        if is_affirmative_only and not provided_start_date and not provided_duration:
-            # User just said 'yes' or similar without giving a date or duration.
-            logger.info("STEP 6: User provided affirmative response but no specific start date. Re-prompting.")
-            state["messages"].append({
-                "id": str(uuid.uuid4()),
-                "type": "ai",
-                "content": "I understand you're ready to set a start date. Could you please provide a specific date or timeframe (e.g., 'next Monday', 'July 1st', 'in two weeks')?"
-            })
-        elif provided_start_date:
-          state["user_input"]["start_date"] = provided_start_date
-          logger.info(f"STEP 6: Captured campaign start date: {provided_start_date}")
-          
-          if provided_duration: # If duration was also captured along with start date
-            state["user_input"]["campaign_duration"] = provided_duration
-            logger.info(f"STEP 6: Captured campaign duration (along with start date): {provided_duration}")
-            state["messages"].append({
-                "id": str(uuid.uuid4()),
-                "type": "ai",
-                "content": f"Great! We'll set the campaign to start {state['user_input']['start_date']} and run for {state['user_input']['campaign_duration']}. Are you ready to generate the final marketing plan now?"
-            })
-          else: # Start date captured, now ask for duration
-            state["messages"].append({
-                "id": str(uuid.uuid4()),
-                "type": "ai",
-                "content": f"Okay, campaign start is set for {state['user_input']['start_date']}. How long should the campaign run (e.g., '3 months', '6 weeks')?"
-            })
-        elif provided_duration and not provided_start_date: # Duration given when start date was expected
-            state["user_input"]["campaign_duration"] = provided_duration # Store it
-            logger.info(f"STEP 6: Captured campaign duration: {provided_duration}, but start date is still missing. Re-prompting for start date.")
-            state["messages"].append({
-                "id": str(uuid.uuid4()),
-                "type": "ai",
-                "content": f"Got the campaign duration as {provided_duration}. When should the campaign start? Please provide a specific date or timeframe."
-            })
-        else: # No start date, not a simple affirmative (that case is handled above), so response was likely unclear or irrelevant for date.
-          logger.info("STEP 6: No specific start date provided or response unclear. Re-prompting.")
-          state["messages"].append({
-              "id": str(uuid.uuid4()),
-              "type": "ai",
-              "content": "When would you like to start the campaign? Please provide a date or timeframe (e.g., 'next Monday', 'July 1st', 'in two weeks')."
-          })
+        # Store whatever was provided, then pick the reply for this combination
+        if provided_start_date:
+          user_input["start_date"] = provided_start_date
+        if provided_duration:
+          user_input["campaign_duration"] = provided_duration
+        # A bare 'yes' only matters when nothing else was provided
+        situation = (
+          bool(provided_start_date),
+          bool(provided_duration),
+          bool(is_affirmative_only) and not provided_start_date and not provided_duration
+        )
+        logger.info("STEP 6: Start date: %s, duration: %s, affirmative only: %s", *situation)
+        state["messages"].append({
+          "id": new_message_id(),
+          "type": "ai",
+          "content": _START_DATE_STEP_REPLIES[situation].format_map(user_input)
+        })
         return state
 
       # Check if we have start date but are waiting for duration
-      elif state.get("user_input", {}).get("start_date") and not state.get("user_input", {}).get("campaign_duration"):
+      elif user_input.get("start_date") and not user_input.get("campaign_duration"):
         logger.info("STEP 6: Have start date, waiting for campaign duration.")
         analysis_context = {"current_stage": "refinement", "start_date_already_set": True}
         analysis = analyze_user_response(message_content, analysis_context, "campaign_start_date") # Re-use, it extracts duration
@@ -500,32 +632,33 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
                  if any(char.isdigit() for char in provided_duration) or \
                     any(word in provided_duration.lower() for word in ["week", "month", "year", "day"]):
                      is_meaningful_duration = True
-             except: pass # Ignore errors in this simple check
+             except Exception as e: # An error in this simple check leaves the duration treated as vague
+                 logger.warning("STEP 6: Duration check failed: %s", e)
              
              if not is_meaningful_duration:
-                logger.info(f"STEP 6: Affirmative response interpreted as duration ('{provided_duration}'), but it seems too vague. Re-prompting.")
+                logger.info("STEP 6: Affirmative response interpreted as duration ('%s'), but it seems too vague. Re-prompting.", provided_duration)
                 state["messages"].append({
-                    "id": str(uuid.uuid4()),
+                    "id": new_message_id(),
                     "type": "ai",
                     "content": "I understand you're ready to set the duration. Could you please specify how long the campaign should run (e.g., '3 months', '6 weeks')?"
                 })
                 return state # Return early to prevent setting a vague duration
 
-          state["user_input"]["campaign_duration"] = provided_duration
-          logger.info(f"STEP 6: Captured campaign duration: {provided_duration}")
+          user_input["campaign_duration"] = provided_duration
+          logger.info("STEP 6: Captured campaign duration: %s", provided_duration)
           state["messages"].append({
-              "id": str(uuid.uuid4()),
+              "id": new_message_id(),
               "type": "ai",
-              "content": f"Great! We'll set the campaign to start {state['user_input']['start_date']} and run for {state['user_input']['campaign_duration']}. Are you ready to generate the final marketing plan now?"
+              "content": _READY_TO_GENERATE_REPLY.format_map(user_input)
           })
-        elif alternative_start_date and alternative_start_date != state["user_input"]["start_date"]:
-            logger.info(f"STEP 6: User provided a new start date '{alternative_start_date}' instead of duration.")
-            state["user_input"]["start_date"] = alternative_start_date
+        elif alternative_start_date and alternative_start_date != user_input["start_date"]:
+            logger.info("STEP 6: User provided a new start date '%s' instead of duration.", alternative_start_date)
+            user_input["start_date"] = alternative_start_date
             # Clear previously asked-for duration, as context changed.
-            if "campaign_duration" in state["user_input"]:
-                del state["user_input"]["campaign_duration"] 
+            if "campaign_duration" in user_input:
+                del user_input["campaign_duration"] 
             state["messages"].append({
-                "id": str(uuid.uuid4()),
+                "id": new_message_id(),
                 "type": "ai",
                 "content": f"Okay, updated campaign start to {state['user_input']['start_date']}. How long should the campaign run (e.g., '3 months', '6 weeks')?"
             })
@@ -533,14 +666,14 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
             # User just said 'yes' or similar to the question "How long should it run?"
             logger.info("STEP 6: User provided affirmative response but no specific duration. Re-prompting.")
             state["messages"].append({
-                "id": str(uuid.uuid4()),
+                "id": new_message_id(),
                 "type": "ai",
                 "content": "I understand you're ready to set the duration. Could you please specify how long the campaign should run (e.g., '3 months', '6 weeks')?"
             })
         else: # No duration provided, not an affirmative, not a new start date.
           logger.info("STEP 6: No specific campaign duration provided or response unclear. Re-prompting.")
           state["messages"].append({
-              "id": str(uuid.uuid4()),
+              "id": new_message_id(),
               "type": "ai",
               "content": "How long should the campaign run? For example, '3 months' or '6 weeks'."
           })
@@ -551,8 +684,8 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
     if state["current_stage"] == "refinement" and "generate" in last_ai_content and ("final" in last_ai_content or "plan" in last_ai_content):
       # Use intelligent analysis to understand if the user is confirming
       context_info = {
-        "industry": state.get("business_info", {}).get("industry", ""),
-        "focus": state.get("user_input", {}).get("focus", "")
+        "industry": industry,
+        "focus": user_input.get("focus", "")
       }
       analysis = analyze_user_response(message_content, context_info, "final_confirmation")
 
@@ -562,11 +695,11 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
         logger.info("User confirmed final plan generation")
         try:
           return generate_final_plan(state) # Call the graph node function
-        except Exception as e:
-          logger.error(f"Error generating final plan: {str(e)}")
+        except _PLAN_ERRORS as e:
+          logger.error("Error generating final plan: %s", e)
           # Basic fallback
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": "I encountered an error generating your plan. Please try again."
           })
@@ -577,7 +710,7 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
           # User requested changes, acknowledge them
           changes = ", ".join(analysis.get("requested_changes"))
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": f"I understand you'd like to adjust {changes}. Let me know when you're ready for me to generate the final marketing plan."
           })
@@ -585,21 +718,21 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
           # User asked for more information
           info_needed = ", ".join(analysis.get("needs_information"))
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": f"I'll be happy to provide more information about {info_needed}. After that, would you like me to generate the final marketing plan?"
           })
         elif analysis.get("hesitant"):
           # User seems hesitant
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": "I understand you may have some hesitations. Is there anything specific you'd like to adjust before I generate the final marketing plan?"
           })
         else:
           # Generic confirmation request
           state["messages"].append({
-            "id": str(uuid.uuid4()),
+            "id": new_message_id(),
             "type": "ai",
             "content": "Would you like me to generate the final marketing media plan now? Please confirm."
           })
@@ -608,84 +741,43 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
     # STEP 8: Handle modifications after a plan has been generated
     if state["current_stage"] == "final":
       logger.info("STEP 8: Processing user input after plan generation (Stage: final)")
+      messages = state["messages"]
       context_info = {
-          "budget_display": state.get("user_input", {}).get("budget", "unknown"),
-          "start_date": state.get("user_input", {}).get("start_date", "unknown"),
-          "campaign_duration": state.get("user_input", {}).get("campaign_duration", "unknown")
+          "budget_display": user_input.get("budget", "unknown"),
+          "start_date": user_input.get("start_date", "unknown"),
+          "campaign_duration": user_input.get("campaign_duration", "unknown")
       }
-      analysis = analyze_user_response(message_content, context_info, "plan_modification_request")
+      analysis = _quick_plan_reply_analysis(message_content) or \
+        analyze_user_response(message_content, context_info, "plan_modification_request")
 
       if analysis.get("wants_budget_change") or analysis.get("wants_timeline_change"):
         logger.info("STEP 8: User expressed desire to modify the plan. Clearing old parameters and collecting new ones.")
 
         # Clear old modification-related parameters to ensure we collect fresh ones
-        state["user_input"]["budget"] = None
-        state["user_input"]["budget_value"] = None
-        state["user_input"]["currency"] = None
-        state["user_input"]["currency_symbol"] = None
-        state["user_input"]["start_date"] = None
-        state["user_input"]["campaign_duration"] = None
+        user_input["budget"] = None
+        user_input["budget_value"] = None
+        user_input["currency"] = None
+        user_input["currency_symbol"] = None
+        user_input["start_date"] = None
+        user_input["campaign_duration"] = None
         
+        # Populate with any new values provided in THIS user message,
+        # then determine what's STILL missing and ask for all of it
+        missing_mask, updated = _apply_modification_update(user_input, analysis)
         current_inputs_log = []
-
-        # Populate with any new values provided in THIS user message
-        if analysis.get("new_budget_original_format"):
-          state["user_input"]["budget"] = analysis["new_budget_original_format"]
-          state["user_input"]["budget_value"] = analysis.get("new_budget_converted_standard_value") or analysis.get("new_budget_amount")
-          state["user_input"]["currency"] = analysis.get("new_budget_currency", state.get("user_input",{}).get("currency_default", "USD")) # Keep a default or previous if any
-          state["user_input"]["currency_symbol"] = analysis.get("new_budget_currency_symbol", state.get("user_input",{}).get("currency_symbol_default", "$"))
-          logger.info(f"STEP 8: From user's current message, captured new budget: {state['user_input']['budget']}")
-          current_inputs_log.append(f"new budget of {state['user_input']['budget']}")
-
-        if analysis.get("new_start_date"):
-          state["user_input"]["start_date"] = analysis["new_start_date"]
-          logger.info(f"STEP 8: From user's current message, captured new start date: {state['user_input']['start_date']}")
-          current_inputs_log.append(f"new start date of {state['user_input']['start_date']}")
-
-        if analysis.get("new_campaign_duration"):
-          state["user_input"]["campaign_duration"] = analysis["new_campaign_duration"]
-          logger.info(f"STEP 8: From user's current message, captured new campaign duration: {state['user_input']['campaign_duration']}")
-          current_inputs_log.append(f"new campaign duration of {state['user_input']['campaign_duration']}")
-
-        # Now, determine what's STILL missing and ask for all of it
-        missing_parts = []
-        if not state["user_input"].get("budget"):
-          missing_parts.append("the new budget")
-        if not state["user_input"].get("start_date"):
-          missing_parts.append("the new campaign start date")
-        if not state["user_input"].get("campaign_duration"):
-          missing_parts.append("the new campaign duration")
-
-        ai_message_content = "Okay, you'd like to refine the plan. "
-        if current_inputs_log:
-            ai_message_content += f"I've noted your request for {', and '.join(current_inputs_log)}. "
-        
-        if missing_parts:
-            ai_message_content += f"To regenerate the plan, please also provide {', and '.join(missing_parts)}."
-            state["messages"].append({"id": str(uuid.uuid4()), "type": "ai", "content": ai_message_content})
+        for name, value in updated:
+          logger.info("STEP 8: From user's current message, captured new %s: %s", name, value)
+          current_inputs_log.append(f"new {name} of {value}")
+
+        if missing_mask:
+            noted = _MOD_NOTED_TEMPLATE.format(noted=", and ".join(current_inputs_log)) if current_inputs_log else ""
+            ai_message_content = _MOD_MISSING_REPLY.format(noted=noted, missing=_MISSING_PARTS_TEXT[missing_mask])
+            messages.append({"id": new_message_id(), "type": "ai", "content": ai_message_content})
             state["current_stage"] = "awaiting_plan_modification_details"
-            logger.info(f"STEP 8: Moving to 'awaiting_plan_modification_details'. Asking for: {', '.join(missing_parts)}")
+            logger.info("STEP 8: Moving to 'awaiting_plan_modification_details'. Asking for: %s", _MISSING_PARTS_TEXT[missing_mask])
         else: # All three (budget, start_date, duration) were somehow provided in the single modification request
             logger.info("STEP 8: All modification details (budget, start date, duration) captured in one go.")
-            state["marketing_channels"] = [] # Clear plan components for regeneration
-            state["budget_allocation"] = {}
-            state["ad_creatives"] = []
-            confirmation_message = (
-                f"Great! I'll regenerate the plan with the updated "
-                f"budget: {state['user_input']['budget']}, "
-                f"start date: {state['user_input']['start_date']}, "
-                f"and campaign duration: {state['user_input']['campaign_duration']}. "
-                f"Generating now..."
-            )
-            state["messages"].append({"id": str(uuid.uuid4()), "type": "ai", "content": confirmation_message})
-            state["current_stage"] = "refinement"
-            logger.info("STEP 8: All details provided. Set stage to 'refinement' for plan regeneration.")
-            try:
-                return generate_final_plan(state)
-            except Exception as e:
-                logger.error(f"Error regenerating final plan after modification in STEP 8: {str(e)}")
-                state["messages"].append({"id": str(uuid.uuid4()), "type": "ai", "content": "I encountered an error while trying to regenerate your plan. Please try describing your changes again."})
-                state["current_stage"] = "final" # Revert to final if regeneration fails
+            return _regenerate_modified_plan(state, _MOD_REGENERATE_REPLY.format_map(user_input), "STEP 8")
         return state
 
       # This condition is now stricter: user must be confirmed happy AND explicitly NOT want changes.
@@ -694,16 +786,16 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
             not analysis.get("wants_timeline_change")) or \
            analysis.get("requested_download_or_email"): # Requesting download/email is also a path to close this loop.
         logger.info("STEP 8: User is happy with the plan (and no pending changes identified) or requested download/email.")
-        state["messages"].append({
-            "id": str(uuid.uuid4()),
+        messages.append({
+            "id": new_message_id(),
             "type": "ai",
             "content": "Great! If you need anything else, just let me know. You can ask to download or email the plan again if you need to."
         })
         return state
       else:
         logger.info("STEP 8: User response after plan is unclear, asking for clarification on modification intent.")
-        state["messages"].append({
-            "id": str(uuid.uuid4()),
+        messages.append({
+            "id": new_message_id(),
             "type": "ai",
             "content": "I'm not sure I understood. Are you happy with the current plan, or would you like to change the budget, campaign start date, or campaign duration to regenerate it? You can also ask to download or email the plan."
         })
@@ -712,84 +804,38 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
     # Stage to handle collecting missing modification details over potentially multiple turns
     elif state["current_stage"] == "awaiting_plan_modification_details":
       logger.info("AWAITING_MOD_DETAILS: Processing user input for missing plan modification details.")
+      messages = state["messages"]
       # Use the same analysis type; it extracts any of budget, start_date, duration
       analysis = analyze_user_response(message_content, {}, "plan_modification_request")
 
-      updated_in_this_turn_log = []
-      # Populate with any new values IF THEY ARE CURRENTLY MISSING
-      if not state["user_input"].get("budget") and analysis.get("new_budget_original_format"):
-          state["user_input"]["budget"] = analysis["new_budget_original_format"]
-          state["user_input"]["budget_value"] = analysis.get("new_budget_converted_standard_value") or analysis.get("new_budget_amount")
-          state["user_input"]["currency"] = analysis.get("new_budget_currency", state.get("user_input",{}).get("currency_default", "USD"))
-          state["user_input"]["currency_symbol"] = analysis.get("new_budget_currency_symbol", state.get("user_input",{}).get("currency_symbol_default", "$"))
-          updated_in_this_turn_log.append(f"budget set to {state['user_input']['budget']}")
-      
-      if not state["user_input"].get("start_date") and analysis.get("new_start_date"):
-          state["user_input"]["start_date"] = analysis["new_start_date"]
-          updated_in_this_turn_log.append(f"start date set to {state['user_input']['start_date']}")
-
-      if not state["user_input"].get("campaign_duration") and analysis.get("new_campaign_duration"):
-          state["user_input"]["campaign_duration"] = analysis["new_campaign_duration"]
-          updated_in_this_turn_log.append(f"campaign duration set to {state['user_input']['campaign_duration']}")
-      
-      if updated_in_this_turn_log:
-          logger.info(f"AWAITING_MOD_DETAILS: From user's latest message, updated: {', '.join(updated_in_this_turn_log)}")
-
-      # Check again what's still missing
-      missing_parts = []
-      if not state["user_input"].get("budget"):
-        missing_parts.append("the new budget")
-      if not state["user_input"].get("start_date"):
-        missing_parts.append("the new campaign start date")
-      if not state["user_input"].get("campaign_duration"):
-        missing_parts.append("the new campaign duration")
-
-      if missing_parts:
-        ai_message_content = "Thanks for that information. "
-        # Acknowledge what was just provided if anything, before asking for more.
-        # This part could be made smarter, e.g. by looking at `updated_in_this_turn_log`
-        # For now, a generic "Thanks!"
-        ai_message_content += f"To regenerate the plan, I still need you to provide {', and '.join(missing_parts)}."
-        state["messages"].append({"id": str(uuid.uuid4()), "type": "ai", "content": ai_message_content})
-        logger.info(f"AWAITING_MOD_DETAILS: Still missing: {', '.join(missing_parts)}. Re-prompting.")
+      # Populate with any new values IF THEY ARE CURRENTLY MISSING, and check again what's still missing
+      missing_mask, updated = _apply_modification_update(user_input, analysis)
+      if updated:
+          logger.info("AWAITING_MOD_DETAILS: From user's latest message, updated: %s", ", ".join(f"{name} set to {value}" for name, value in updated))
+
+      if missing_mask:
+        # A generic "Thanks!"; this could acknowledge what was just provided, e.g. from `updated`
+        ai_message_content = _MOD_STILL_MISSING_REPLY.format(missing=_MISSING_PARTS_TEXT[missing_mask])
+        messages.append({"id": new_message_id(), "type": "ai", "content": ai_message_content})
+        logger.info("AWAITING_MOD_DETAILS: Still missing: %s. Re-prompting.", _MISSING_PARTS_TEXT[missing_mask])
         return state
       else:
         # All three (budget, start date, duration) are now collected
         logger.info("AWAITING_MOD_DETAILS: All modification details (budget, start date, duration) now collected.")
-        state["marketing_channels"] = [] # Clear plan components for regeneration
-        state["budget_allocation"] = {}
-        state["ad_creatives"] = []
-        
-        confirmation_message = (
-            f"Excellent, all details received! I'll regenerate the plan with the "
-            f"budget: {state['user_input']['budget']}, "
-            f"start date: {state['user_input']['start_date']}, "
-            f"and campaign duration: {state['user_input']['campaign_duration']}. "
-            f"Generating now..."
-        )
-        state["messages"].append({"id": str(uuid.uuid4()), "type": "ai", "content": confirmation_message})
-        state["current_stage"] = "refinement"
-        logger.info("AWAITING_MOD_DETAILS: All details collected. Set stage to 'refinement' for plan regeneration.")
-        try:
-          return generate_final_plan(state)
-        except Exception as e:
-          logger.error(f"Error regenerating final plan after collecting all modification details: {str(e)}")
-          state["messages"].append({"id": str(uuid.uuid4()), "type": "ai", "content": "I encountered an error while trying to regenerate your plan. Please try describing your changes again."})
-          state["current_stage"] = "final" # Revert to final if regeneration fails
-          return state
+        return _regenerate_modified_plan(state, _MOD_COLLECTED_REPLY.format_map(user_input), "AWAITING_MOD_DETAILS")
 
     # If execution reaches here, it means direct stage handling did not return.
     # This could be a new message after the plan is delivered, or an unhandled state.
     # Use the graph to process the current state.
-    logger.info(f"Invoking LangGraph for stage: {state['current_stage']} based on current state logic.")
-    result = marketing_agent.invoke(state)
+    logger.info("Invoking LangGraph for stage: %s based on current state logic.", state["current_stage"])
+    result = get_agent().invoke(state)
     return result
 
   except Exception as e:
-    logger.error(f"General error in on_message: {str(e)}", exc_info=True)
+    logger.error("General error in on_message: %s", e, exc_info=True)
     # Add fallback response
     fallback_message = {
-      "id": str(uuid.uuid4()),
+      "id": new_message_id(),
       "type": "ai",
       "content": "I seem to be having trouble processing that. Could you please try again?"
     }
@@ -797,73 +843,76 @@ def on_message(state: MarketingPlanState, message: Dict[str, Any]):
     if "messages" not in state:
       state["messages"] = []
     state["messages"].append(fallback_message)
-    logger.info(f"Adding fallback message due to general error: {fallback_message['id']}")
+    logger.info("Adding fallback message due to general error: %s", fallback_message["id"])
 
   return state
 
 # Test function to directly run the LangGraph workflow
 if __name__ == "__main__":
   import sys
+  from concurrent.futures import ThreadPoolExecutor
 
   logger.info("=== Marketing Agent LangGraph Test ===")
 
-  # Create initial state
-  test_state: MarketingPlanState = {
-    "messages": [],
-    "business_info": {},
-    "competitor_info": [],
-    "marketing_channels": [],
-    "budget_allocation": {},
-    "ad_creatives": [],
-    "user_input": {},
-    "current_stage": "initial"
-  }
-
+  # Scripted user turns after the greeting and URL: (message id, label, content)
+  test_turns = [
+    ("industry-confirm", "User confirms industry (e.g., AI Software)", "Yes, that's correct."),
+    ("budget-msg", "User provides budget (e.g., $10000)", "$10000 per month"),
+    ("focus-msg", "User provides marketing focus (e.g., balanced)", "A balanced approach sounds good."),
+    ("date-msg", "User provides campaign start date (e.g., next month)", "Let's start next month."),
+    ("final-confirm-msg", "User confirms final plan generation", "Yes, generate the plan.")
+  ]
+
+  def print_messages(state: MarketingPlanState) -> None:
+    for msg in state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
+
+  def run_test_session(test_url: str, verbose: bool) -> MarketingPlanState:
+    """Run one scripted conversation; transcripts are only printed when verbose."""
+    # Create initial state
+    test_state: MarketingPlanState = {
+      "messages": [],
+      "business_info": {},
+      "competitor_info": [],
+      "marketing_channels": [],
+      "budget_allocation": {},
+      "ad_creatives": [],
+      "user_input": {},
+      "current_stage": "initial"
+    }
 
-  print("\n--- Initial State (Agent Asks for URL) ---")
-  test_state = on_message(test_state, {"id": "init", "content": "hi"}) # Initial greeting from user
-  for msg in test_state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
+    if verbose: print("\n--- Initial State (Agent Asks for URL) ---")
+    test_state = on_message(test_state, {"id": "init", "content": "hi"}) # Initial greeting from user
+    if verbose: print_messages(test_state)
+
+    if verbose: print(f"\n--- User provides URL: {test_url} ---")
+    test_state = on_message(test_state, {"id": "url-msg", "content": test_url})
+    if verbose: print_messages(test_state)
+
+    for message_id, label, content in test_turns:
+      if verbose:
+        print(f"\n--- {label} ---")
+        # The last AI message is the question this turn answers
+        last_ai_q = [m['content'] for m in test_state['messages'] if m['type']=='ai'][-1]
+        print(f"AI asked: {last_ai_q}")
+      test_state = on_message(test_state, {"id": message_id, "content": content})
+      if verbose and message_id != "final-confirm-msg": print_messages(test_state)
+
+    if verbose:
+      # The final plan might be long, so just print the last few messages
+      print("Last few messages after final plan generation:")
+      for msg in test_state.get("messages", [])[-3:]: print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')[:200]}...")
+    return test_state
 
   test_url = sys.argv[1] if len(sys.argv) > 1 else "https://www.langchain.com" # Example URL
-  print(f"\n--- User provides URL: {test_url} ---")
-  test_state = on_message(test_state, {"id": "url-msg", "content": test_url})
-  for msg in test_state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
-
-  print(f"\n--- User confirms industry (e.g., AI Software) ---")
-  # Assuming the agent identified "AI Software" or similar and asked for confirmation.
-  # We need to find the last AI message asking for confirmation.
-  last_ai_q = [m['content'] for m in test_state['messages'] if m['type']=='ai'][-1]
-  print(f"AI asked: {last_ai_q}")
-  test_state = on_message(test_state, {"id": "industry-confirm", "content": "Yes, that's correct."})
-  for msg in test_state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
-
-  print(f"\n--- User provides budget (e.g., $10000) ---")
-  last_ai_q = [m['content'] for m in test_state['messages'] if m['type']=='ai'][-1]
-  print(f"AI asked: {last_ai_q}")
-  test_state = on_message(test_state, {"id": "budget-msg", "content": "$10000 per month"})
-  for msg in test_state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
-
-  print(f"\n--- User provides marketing focus (e.g., balanced) ---")
-  last_ai_q = [m['content'] for m in test_state['messages'] if m['type']=='ai'][-1]
-  print(f"AI asked: {last_ai_q}")
-  test_state = on_message(test_state, {"id": "focus-msg", "content": "A balanced approach sounds good."})
-  for msg in test_state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
-
-  print(f"\n--- User provides campaign start date (e.g., next month) ---")
-  last_ai_q = [m['content'] for m in test_state['messages'] if m['type']=='ai'][-1]
-  print(f"AI asked: {last_ai_q}")
-  test_state = on_message(test_state, {"id": "date-msg", "content": "Let's start next month."})
-  for msg in test_state.get("messages", []): print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')}")
-
-  print(f"\n--- User confirms final plan generation ---")
-  last_ai_q = [m['content'] for m in test_state['messages'] if m['type']=='ai'][-1]
-  print(f"AI asked: {last_ai_q}")
-  test_state = on_message(test_state, {"id": "final-confirm-msg", "content": "Yes, generate the plan."})
-  # The final plan might be long, so just print the last few messages
-  print("Last few messages after final plan generation:")
-  for msg in test_state.get("messages", [])[-3:]: print(f"{msg.get('type','unknown').upper()}: {msg.get('content','no_content')[:200]}...")
-
-
-  logger.info(f"Final state stage after test: {test_state.get('current_stage', 'unknown')}")
+  # An optional session count runs that many conversations at once, to exercise the shared LLM limits
+  session_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+  if session_count == 1:
+    test_state = run_test_session(test_url, verbose=True)
+    logger.info("Final state stage after test: %s", test_state.get("current_stage", "unknown"))
+  else:
+    with ThreadPoolExecutor(max_workers=session_count) as executor:
+      final_states = list(executor.map(lambda _: run_test_session(test_url, verbose=False), range(session_count)))
+    for position, final_state in enumerate(final_states):
+      logger.info("Session %d final stage: %s", position, final_state.get("current_stage", "unknown"))
   logger.info("=== Test Complete ===")
-
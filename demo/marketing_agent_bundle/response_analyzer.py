@@ -1,24 +1,39 @@
-from langchain_openai import ChatOpenAI
+from typing import Any, Dict, Optional, Tuple
 import json
 import logging
+import re
+import threading
+import time
+
+from .json_utils import loads_lenient
+from .llm_client import get_llm
 
 logger = logging.getLogger(__name__)
 
-# Add this helper function to intelligently analyze user responses with LLM
-def analyze_user_response(user_message, context_info, question_type):
-  """
-  Use LLM to intelligently analyze user responses based on context and question type.
-  Returns structured information based on the type of question being answered.
-  """
-  logger.info(f"Analyzing user response for question type: {question_type}")
+# Successful analyses keyed by (normalized message, question type, context) and stored as
+# (stored_at, analysis); failures are not cached. Entries expire so relative dates
+# ("next month") are not resolved against a stale day
+_ANALYSIS_CACHE_MAX_ENTRIES = 2048
+_ANALYSIS_CACHE_TTL_SECONDS = 3600
+_analysis_cache: Dict[Tuple[str, str, str], Tuple[float, Dict[str, Any]]] = {}
+_analysis_cache_lock = threading.Lock()
+_WHITESPACE_RE = re.compile(r"\s+")
 
-  llm = ChatOpenAI(model="gpt-4o", temperature=0)
+def _normalize_message(user_message: str) -> str:
+  """Lowercase and collapse whitespace for the cache key; the prompt keeps the original text."""
+  return _WHITESPACE_RE.sub(" ", user_message.strip().lower())
 
-  if question_type == "industry_confirmation":
-    prompt = f"""
-    Analyze this user response: "{user_message}"
+def _analysis_cache_key(user_message: str, context_info: Optional[Dict[str, Any]], question_type: str) -> Tuple[str, str, str]:
+  context_key = json.dumps(context_info or {}, sort_keys=True, default=str)
+  return (_normalize_message(user_message), question_type, context_key)
+
+# Fixed instructions per question type, sent as the system message. They come first and never
+# change between calls, so the provider's prompt-prefix cache can reuse them
+_ANALYSIS_INSTRUCTIONS: Dict[str, str] = {
+  "industry_confirmation": """
+    Analyze the user response given below.
     
-    Context: The user was asked to confirm if their business is in the {context_info.get('industry', '')} industry.
+    Context: The user was asked to confirm if their business is in the industry named below.
     
     Determine if the user is:
     1. Confirming (agreeing that the industry is correct)
@@ -31,11 +46,10 @@ def analyze_user_response(user_message, context_info, question_type):
     - "needs_clarification": true/false - if they seem confused or asked for clarification
     
     ONLY return the JSON object, nothing else.
-    """
+    """,
 
-  elif question_type == "budget_extraction":
-    prompt = f"""
-    Analyze this user response about their marketing budget: "{user_message}"
+  "budget_extraction": """
+    Analyze the user response about their marketing budget given below.
     
     Consider the following:
     1. What currency is being used (USD, rupees, euros, etc.)
@@ -59,14 +73,13 @@ def analyze_user_response(user_message, context_info, question_type):
     - "converted_standard_value": the budget converted to standard notation (e.g., 200000000 for "20 crores")
     
     ONLY return the JSON object, nothing else.
-    """
+    """,
 
-  elif question_type == "marketing_focus":
-    prompt = f"""
-    Analyze this user message about marketing focus preferences: "{user_message}"
+  "marketing_focus": """
+    Analyze the user message about marketing focus preferences given below.
     
     Context: The user was asked if they prefer to focus on social media marketing, search ads, or a balanced approach.
-    Their business is in the {context_info.get('industry', '')} industry with a budget of {context_info.get('budget', '')}.
+    Their business's industry and budget are given below.
     
     Deeply analyze their response to understand their true intent, considering:
     1. Do they explicitly mention social media platforms (Facebook, Instagram, TikTok, etc.)?
@@ -82,14 +95,13 @@ def analyze_user_response(user_message, context_info, question_type):
     - "needs_clarification": true/false
     
     ONLY return the JSON object, nothing else.
-    """
+    """,
 
-  elif question_type == "instagram_allocation":
-    prompt = f"""
-    Analyze this user response about Instagram budget allocation: "{user_message}"
+  "instagram_allocation": """
+    Analyze the user response about Instagram budget allocation given below.
     
     Context: The user was asked if they'd like to allocate a larger portion of their budget to Instagram ads.
-    Their business is in the {context_info.get('industry', '')} industry.
+    Their business's industry is given below.
     
     Determine:
     1. Are they agreeing to increase Instagram budget?
@@ -104,11 +116,10 @@ def analyze_user_response(user_message, context_info, question_type):
     - "concerns": array of any concerns mentioned
     
     ONLY return the JSON object, nothing else.
-    """
+    """,
 
-  elif question_type == "campaign_start_date":
-    prompt = f"""
-    Analyze this user response: "{user_message}"
+  "campaign_start_date": """
+    Analyze the user response given below.
     The user was likely asked about when to start a marketing campaign or for campaign duration.
     
     Consider:
@@ -117,7 +128,7 @@ def analyze_user_response(user_message, context_info, question_type):
     3. Did they mention a seasonal timing (e.g., "before holiday season", "summer")?
     4. Did they mention a campaign duration (e.g., "3 months", "for 6 weeks")?
     5. Are there any conditions they want met before starting?
-    6. Is the response merely an affirmation (e.g., 'yes', 'okay', 'sounds good', 'let\'s do it') reacting to a question about timing, without providing any *new* specific date, timeframe, or duration information?
+    6. Is the response merely an affirmation (e.g., 'yes', 'okay', 'sounds good', 'let's do it') reacting to a question about timing, without providing any *new* specific date, timeframe, or duration information?
     
     Return your analysis as a JSON object with these fields:
     - "is_affirmative_only": true/false - true if the response is just an affirmation without new timing details.
@@ -132,11 +143,10 @@ def analyze_user_response(user_message, context_info, question_type):
     If the user says "yes, start now", then `is_affirmative_only` could be true (or false, as it contains "now"), `has_date` true, and `relative_timeframe` "now". Use your best judgment. The key is to avoid extracting a date from a simple 'yes'.
     
     ONLY return the JSON object, nothing else.
-    """
+    """,
 
-  elif question_type == "final_confirmation":
-    prompt = f"""
-    Analyze this user response about generating a final marketing plan: "{user_message}"
+  "final_confirmation": """
+    Analyze the user response about generating a final marketing plan given below.
     
     Consider:
     1. Are they confirming they want the final plan?
@@ -151,17 +161,12 @@ def analyze_user_response(user_message, context_info, question_type):
     - "hesitant": true/false - whether they seem hesitant
     
     ONLY return the JSON object, nothing else.
-    """
+    """,
 
-  elif question_type == "plan_modification_request":
-    prompt = f"""
-    Analyze this user response regarding changes to an existing marketing plan: "{user_message}"
+  "plan_modification_request": """
+    Analyze the user response regarding changes to an existing marketing plan given below.
     The user has already seen a marketing plan (and may have already refined it once or multiple times) and is now potentially asking for further modifications.
-    
-    Contextual Information (current plan details):
-    - Current Budget: {context_info.get('budget_display', 'unknown')}
-    - Current Timeline/Start Date: {context_info.get('start_date', 'unknown')}
-    - Current Campaign Duration: {context_info.get('campaign_duration', 'unknown')}
+    The current plan details are given below.
     
     Determine if the user wants to:
     1. Change the marketing budget.
@@ -203,63 +208,125 @@ def analyze_user_response(user_message, context_info, question_type):
     - Pay attention to Indian number formats for budget (lakhs, crores).
     
     For example, if user says "change budget to 1 million dollars and timeline to 2 months":
-    {{ 
+    { 
       "wants_budget_change": true, "new_budget_amount": 1000000, "new_budget_currency": "USD", "new_budget_currency_symbol": "$", "new_budget_original_format": "1 million dollars", "new_budget_converted_standard_value": 1000000,
       "wants_timeline_change": true, "new_start_date": null, "new_campaign_duration": "2 months",
       "confirmed_happy_with_plan": false, "requested_download_or_email": false, "other_request": null
-    }}
+    }
 
     If user says "I want to modify the plan":
-    {{ 
+    { 
       "wants_budget_change": true, "new_budget_amount": null, "new_budget_currency": null, "new_budget_currency_symbol": null, "new_budget_original_format": null, "new_budget_converted_standard_value": null,
       "wants_timeline_change": false, "new_start_date": null, "new_campaign_duration": null,
       "confirmed_happy_with_plan": false, "requested_download_or_email": false, "other_request": null
-    }}
+    }
     
     If user says "the plan looks good, email it to me":
-    {{ 
+    { 
       "wants_budget_change": false, "new_budget_amount": null, "new_budget_currency": null, "new_budget_currency_symbol": null, "new_budget_original_format": null, "new_budget_converted_standard_value": null,
       "wants_timeline_change": false, "new_start_date": null, "new_campaign_duration": null,
       "confirmed_happy_with_plan": true, "requested_download_or_email": true, "other_request": null
-    }}
+    }
 
     If user says "What if we run it for 6 weeks instead?" after seeing a plan:
-     {{ 
+     { 
       "wants_budget_change": false, "new_budget_amount": null, "new_budget_currency": null, "new_budget_currency_symbol": null, "new_budget_original_format": null, "new_budget_converted_standard_value": null,
       "wants_timeline_change": true, "new_start_date": null, "new_campaign_duration": "6 weeks",
       "confirmed_happy_with_plan": false, "requested_download_or_email": false, "other_request": null
-    }}
+    }
 
     If user says "Looks good, but let's change the start date to next Monday":
-     {{ 
+     { 
       "wants_budget_change": false, "new_budget_amount": null, "new_budget_currency": null, "new_budget_currency_symbol": null, "new_budget_original_format": null, "new_budget_converted_standard_value": null,
       "wants_timeline_change": true, "new_start_date": "next Monday", "new_campaign_duration": null,
       "confirmed_happy_with_plan": false, "requested_download_or_email": false, "other_request": null
-    }}
+    }
 
     ONLY return the JSON object, nothing else.
     """
-  else: # Should not happen with defined question_types
-    logger.error(f"Unknown question type for analysis: {question_type}")
-    return {}
+}
 
+# Per-call details, sent after the instructions as the human message; filled with format_map
+_ANALYSIS_CONTEXT_TEMPLATES: Dict[str, str] = {
+  "industry_confirmation": """Industry: {industry}
 
-  try:
-    analysis_result = llm.invoke(prompt)
-    response_text = analysis_result.content.strip()
+User response: "{user_message}"
+""",
+  "budget_extraction": """User response: "{user_message}"
+""",
+  "marketing_focus": """Industry: {industry}
+Budget: {budget}
+
+User response: "{user_message}"
+""",
+  "instagram_allocation": """Industry: {industry}
+
+User response: "{user_message}"
+""",
+  "campaign_start_date": """User response: "{user_message}"
+""",
+  "final_confirmation": """User response: "{user_message}"
+""",
+  "plan_modification_request": """Contextual Information (current plan details):
+- Current Budget: {budget_display}
+- Current Timeline/Start Date: {start_date}
+- Current Campaign Duration: {campaign_duration}
+
+User response: "{user_message}"
+"""
+}
+
+# Add this helper function to intelligently analyze user responses with LLM
+def analyze_user_response(user_message: str, context_info: Optional[Dict[str, Any]], question_type: str) -> Dict[str, Any]:
+  """
+  Use LLM to intelligently analyze user responses based on context and question type.
+  Returns structured information based on the type of question being answered.
+  """
+  logger.info("Analyzing user response for question type: %s", question_type)
 
-    # Clean up any markdown or formatting
-    if "```json" in response_text:
-      response_text = response_text.split("```json")[1].split("```")[0].strip()
-    elif "```" in response_text:
-      response_text = response_text.split("```")[1].split("```")[0].strip()
+  # Re-prompts and retries often repeat the same short answer ("yes", "next month")
+  cache_key = _analysis_cache_key(user_message, context_info, question_type)
+  with _analysis_cache_lock:
+    cached = _analysis_cache.get(cache_key)
+    if cached is not None:
+      stored_at, cached_analysis = cached
+      if time.monotonic() - stored_at < _ANALYSIS_CACHE_TTL_SECONDS:
+        return dict(cached_analysis)
+      _analysis_cache.pop(cache_key, None)
 
-    # Parse the response as JSON
-    analysis = json.loads(response_text)
-    logger.info(f"Analysis result for {question_type}: {analysis}")
+  instructions = _ANALYSIS_INSTRUCTIONS.get(question_type)
+  if instructions is None: # Should not happen with defined question_types
+    logger.error("Unknown question type for analysis: %s", question_type)
+    return {}
+
+  context_info = context_info or {}
+  prompt = _ANALYSIS_CONTEXT_TEMPLATES[question_type].format_map({
+    # The model copies values (budget formats, dates, industries) from this text into replies, so keep its case
+    "user_message": user_message.strip(),
+    "industry": context_info.get("industry", ""),
+    "budget": context_info.get("budget", ""),
+    "budget_display": context_info.get("budget_display", "unknown"),
+    "start_date": context_info.get("start_date", "unknown"),
+    "campaign_duration": context_info.get("campaign_duration", "unknown")
+  })
+  llm = get_llm()
+
+  try:
+    # JSON mode makes the API return a single JSON object, so the reply parses directly
+    analysis_result = llm.bind(response_format={"type": "json_object"}).invoke([
+      ("system", instructions),
+      ("human", prompt)
+    ])
+    analysis = loads_lenient(analysis_result.content.strip())
+    logger.info("Analysis result for %s: %s", question_type, analysis)
+    if isinstance(analysis, dict):
+      with _analysis_cache_lock:
+        if cache_key not in _analysis_cache and len(_analysis_cache) >= _ANALYSIS_CACHE_MAX_ENTRIES:
+          _analysis_cache.pop(next(iter(_analysis_cache)), None)
+        _analysis_cache[cache_key] = (time.monotonic(), dict(analysis))
     return analysis
   except Exception as e:
-    logger.error(f"Error analyzing user response for {question_type}: {str(e)}")
+    logger.error("Error analyzing user response for %s: %s", question_type, e)
     # Return a default object based on question type
     if question_type == "industry_confirmation":
       return {"confirmed": True, "corrected_industry": None, "needs_clarification": False}
@@ -267,7 +334,6 @@ def analyze_user_response(user_message, context_info, question_type):
       # Check for common Indian currency formats in the raw message
       if "crore" in user_message.lower() or "cr" in user_message.lower():
         # Attempt basic extraction of crore values
-        import re
         match = re.search(r'(\d+)(?:\s*(?:crore|cr|crores))', user_message.lower())
         if match:
           crore_value = int(match.group(1))
@@ -282,7 +348,6 @@ def analyze_user_response(user_message, context_info, question_type):
           }
       elif "lakh" in user_message.lower() or "lac" in user_message.lower():
         # Attempt basic extraction of lakh values
-        import re
         match = re.search(r'(\d+)(?:\s*(?:lakh|lac|lakhs))', user_message.lower())
         if match:
           lakh_value = int(match.group(1))
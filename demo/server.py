@@ -4,6 +4,7 @@ import os
 from server_bundle.app_setup import app, logger
 from server_bundle.routes import main_routes
 from server_bundle.state_management import sync_threads_and_sessions
+from marketing_agent_bundle.marketing_agent import get_agent
 
 # Register the blueprint with the app
 app.register_blueprint(main_routes)
@@ -11,6 +12,7 @@ app.register_blueprint(main_routes)
 def initialize_app_state_on_startup():
     logger.info("Initializing application state on startup...")
     sync_threads_and_sessions()
+    get_agent() # Compile the graph before the first request rather than during it
     logger.info("Application state initialized on startup.")
 
 if __name__ == '__main__':
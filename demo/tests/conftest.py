@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Make marketing_agent_bundle importable when pytest runs from the repo root as well as from demo/
+_DEMO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _DEMO_DIR not in sys.path:
+  sys.path.insert(0, _DEMO_DIR)
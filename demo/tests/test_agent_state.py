@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("pydantic")
+
+from marketing_agent_bundle.agent_state import has_message_id, sync_message_index
+
+def test_question_counts_match_baseline_case_rules():
+  # Only the budget check lowercases the message; the focus and campaign phrases are case-sensitive
+  state = {"messages": [
+    {"id": "system-4", "type": "ai", "content": "Would you like to focus more on social media or search ads?"},
+    {"id": "system-4", "type": "ai", "content": "Would you like to FOCUS MORE ON SOCIAL MEDIA OR SEARCH ADS?"},
+    {"id": "a1", "type": "ai", "content": "When would you like to start the marketing campaign?"},
+    {"id": "a2", "type": "ai", "content": "When would you like to Start The Marketing Campaign?"},
+    {"id": "a3", "type": "ai", "content": "What is your monthly budget?"},
+    {"id": "a4", "type": "ai", "content": "What is your monthly BUDGET?"},
+    {"id": "h1", "type": "human", "content": "My Budget is $5000"}
+  ]}
+
+  index = sync_message_index(state)
+
+  assert index["focus_q_count"] == 1
+  assert index["campaign_q_count"] == 1
+  assert index["budget_q_count"] == 2
+
+def test_has_message_id_tracks_appended_messages():
+  state = {"messages": [{"id": "init", "type": "human", "content": "hi"}]}
+  assert has_message_id(state, "init")
+  assert not has_message_id(state, "url-msg")
+
+  state["messages"].append({"id": "url-msg", "type": "human", "content": "https://example.com"})
+  assert has_message_id(state, "url-msg")